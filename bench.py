@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks on the feeds of samples/.
+
+Usage: python bench.py [options] [benchmark ...]
+
+Scaled benchmarks run on corpora of each of `--sizes` entries or feeds,
+synthesized from the samples, each size in its own process to measure
+its peak RSS. Their results are saved by `--json` and compared with
+results of another commit by `--compare`.
+'''
+
+import copy
+import distutils.spawn
+import itertools
+import json
+import os
+import os.path
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import sanitizer
+import web
+
+from feed import FeedFactory
+from kindlegen import KindleGen, htmlNode
+from lxml import etree
+from StringIO import StringIO
+
+
+SAMPLES = 'samples'
+
+
+def samples():
+    return [os.path.join(SAMPLES, name) for name in sorted(os.listdir(SAMPLES))]
+
+
+def best(fn, repeat, setup=None):
+    '''
+    Return the best seconds of `repeat` calls of `fn`,
+    passed the result of `setup()` which is not timed.
+    '''
+    times = []
+    for i in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def entryContents():
+    '''Return contents of all entries of the samples.'''
+    contents = []
+    for path in samples():
+        for url, title, author, pubdate, summary, content in \
+                FeedFactory.parseFeed(path)[0].items():
+            if content or summary:
+                contents.append((content or summary).encode('utf-8'))
+    return contents
+
+
+def benchParse(repeat):
+    '''Parse feeds and iterate their items, with tree and stream feed types.'''
+    for path in samples():
+        for streaming in (False, True):
+            parse = lambda: list(FeedFactory.parseFeed(path, streaming=streaming)[0].items())
+            print '%-32s %-6s %8.2f ms' % (path, 'stream' if streaming else 'tree',
+                                           best(parse, repeat) * 1000)
+
+
+def xpathClean(html):
+    '''Clean entry html by xpath queries, as FeedManager._writefile did.'''
+    for n in itertools.chain(html.xpath('//img'), \
+                                 html.xpath('//script'), \
+                                 html.xpath('//style')):
+        n.getparent().remove(n)
+    for a in html.xpath('//a'):
+        if not a.text:
+            a.getparent().remove(a)
+
+
+def benchClean(repeat):
+    '''Clean html of the sample entries, by xpath queries and by one tree walk.'''
+    contents = entryContents()
+    parser = etree.HTMLParser(encoding='utf-8')
+    def parse():
+        return [etree.parse(StringIO(c), parser) for c in contents]
+    def cleanAll(clean):
+        return lambda htmls: [clean(html) for html in htmls]
+    for name, clean in (('xpath', xpathClean),
+                        ('walk', lambda html: sanitizer.clean(html.getroot()))):
+        print '%-32s %-6s %8.2f ms' % ('%d entries' % len(contents), name,
+                                       best(cleanAll(clean), repeat, parse) * 1000)
+
+
+def bundle(workdir, size=200):
+    '''Write `size` entry files of the samples in `workdir`, return their rows.'''
+    contents = entryContents()
+    entries = []
+    for i in range(size):
+        html = htmlNode()
+        body = etree.SubElement(html, 'body')
+        etree.SubElement(body, 'h2').text = 'Entry %d' % i
+        body.extend(etree.HTML(contents[i % len(contents)]).find('body').getchildren())
+        path = 'entry%d.html' % i
+        with open(os.path.join(workdir, path), 'w') as fo:
+            fo.write(etree.tostring(html, encoding='utf-8'))
+        entries.append(web.storage(feed_id=i / 20, feed_title='Feed %d' % (i / 20),
+                                   entry_id=i, entry_title='Entry %d' % i,
+                                   author=None, path=path, digest=None))
+    return entries
+
+
+def benchBook(repeat):
+    '''Make a book of 200 entries, by kindlegen and by the epub writer.'''
+    workdir = tempfile.mkdtemp()
+    try:
+        entries = bundle(workdir)
+        backends = [('epub', KindleGen(format='epub'))]
+        if distutils.spawn.find_executable('kindlegen'):
+            backends.append(('mobi', KindleGen()))
+        else:
+            print 'kindlegen not found, mobi skipped'
+        for name, kindlegen in backends:
+            make = lambda: kindlegen.execute('Bench', '2012-05-01', entries, workdir=workdir)
+            seconds = best(make, repeat)
+            size = os.path.getsize(os.path.join(workdir, make()))
+            print '%-32s %-6s %8.2f ms %8d KB' % ('%d entries' % len(entries), name,
+                                                 seconds * 1000, size / 1024)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def percentile(times, p):
+    '''Return `p` percentile of sorted `times`, by nearest rank.'''
+    return times[max(0, int(round(p / 100.0 * len(times))) - 1)]
+
+
+def report(results, name, case, size, times, count=1):
+    '''
+    Print and append to `results` latency percentiles of `times`,
+    seconds of operations on `count` items each, and their throughput.
+    '''
+    times = sorted(times)
+    result = {'benchmark': name, 'case': case, 'size': size, 'ops': len(times),
+              'throughput': count * len(times) / (sum(times) or 1e-9),
+              'p50_ms': percentile(times, 50) * 1000,
+              'p90_ms': percentile(times, 90) * 1000,
+              'p99_ms': percentile(times, 99) * 1000,
+              'max_ms': times[-1] * 1000}
+    print '%-8s %7d %12.0f/s  p50 %9.2f  p90 %9.2f  p99 %9.2f ms' % (
+        case, size, result['throughput'],
+        result['p50_ms'], result['p90_ms'], result['p99_ms'])
+    results.append(result)
+
+
+def runs(repeat, size):
+    '''Return times to run a case on `size` items, fewer for larger sizes.'''
+    return max(3, min(repeat, repeat * 100 / size))
+
+
+def corpus(path, size):
+    '''
+    Return document of sample feed `path` having `size` items, copies of
+    its own items with distinct links and ids.
+    '''
+    doc = etree.parse(path)
+    root = doc.getroot()
+    parent = root.find('channel') if root.find('channel') is not None else root
+    localname = lambda node: node.tag.rsplit('}', 1)[-1] if isinstance(node.tag, basestring) else None
+    items = [node for node in parent if localname(node) in ('item', 'entry')]
+    for item in items:
+        parent.remove(item)
+    for i in range(size):
+        item = copy.deepcopy(items[i % len(items)])
+        for node in item.iter():
+            if localname(node) in ('link', 'guid', 'id', 'title'):
+                if node.text:
+                    node.text = '%s#%d' % (node.text.strip(), i)
+                if node.get('href'):
+                    node.set('href', '%s#%d' % (node.get('href'), i))
+        parent.append(item)
+    return etree.tostring(doc, xml_declaration=True, encoding='utf-8')
+
+
+def quietly(fn, *args, **kwargs):
+    '''Call `fn` without its printed reports.'''
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+
+def benchFeeds(repeat, size, results):
+    '''Parse feeds of `size` items, by FeedFactory.parseFeed and Feed.items.'''
+    workdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for path in samples():
+            paths.append(os.path.join(workdir, os.path.basename(path)))
+            with open(paths[-1], 'w') as fo:
+                fo.write(corpus(path, size))
+        count = size * len(paths)
+        parse = lambda streaming: [FeedFactory.parseFeed(path, streaming=streaming)[0]
+                                   for path in paths]
+        items = lambda feeds: [list(f.items()) for f in feeds]
+        n = runs(repeat, size)
+        report(results, 'feeds', 'parse', size,
+               [best(lambda: parse(False), 1) for i in range(n)], count)
+        report(results, 'feeds', 'items', size,
+               [best(items, 1, lambda: parse(False)) for i in range(n)], count)
+        report(results, 'feeds', 'stream', size,
+               [best(items, 1, lambda: parse(True)) for i in range(n)], count)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def benchIngest(repeat, size, results, chunk=1000):
+    '''
+    Save `size` entries into a new database, `chunk` entries per feed, by
+    FeedManager._updateEntries which writes their contents.
+    '''
+    from feed import FeedManager
+    import storage
+    web.config.debug = False
+    entries = []
+    for path in samples():
+        entries.extend(FeedFactory.parse(path, corpus(path, size / len(samples()) + 1)).items())
+    entries = entries[:size]
+    times = []
+    for r in range(runs(repeat, size)):
+        dirname = tempfile.mkdtemp()
+        try:
+            db = storage.database(os.path.join(dirname, 'bench.db'))
+            mgr = FeedManager(db, datapath=dirname)
+            for i in range(0, size, chunk):
+                feedId = db.insert('feed', url='http://example.com/%d' % i, title='Feed %d' % i)
+                start = time.time()
+                quietly(mgr._updateEntries, feedId, entries[i:i + chunk])
+                times.append(time.time() - start)
+        finally:
+            shutil.rmtree(dirname)
+    report(results, 'ingest', 'save', size, times, min(size, chunk))
+
+
+def benchPaging(repeat, size, results, pages=200):
+    '''Read pages of the top and new lists of `size` feeds, after random cursors.'''
+    from feed import FeedManager
+    import storage
+    web.config.debug = False
+    rand = random.Random(size)
+    dirname = tempfile.mkdtemp()
+    try:
+        db = storage.database(os.path.join(dirname, 'bench.db'))
+        mgr = FeedManager(db, datapath=dirname)
+        with db.transaction():
+            for i in range(size):
+                db.insert('feed', url='http://example.com/%d' % i, title='Feed %d' % i,
+                          subscriber_count=int(rand.paretovariate(1.5)) - 1)
+        feeds = list(db.select('feed', what='id, subscriber_count'))
+        for case, listFeeds, cursor in (
+            ('top', mgr.list, lambda f: (f.subscriber_count, f.id)),
+            ('new', mgr.listNew, lambda f: (f.id,))):
+            times = []
+            for i in range(pages):
+                after = cursor(rand.choice(feeds)) if i else None
+                start = time.time()
+                listFeeds(limit=16, after=after)
+                times.append(time.time() - start)
+            report(results, 'paging', case, size, times)
+    finally:
+        shutil.rmtree(dirname)
+
+
+def benchGenerate(repeat, size, results):
+    '''Write TOC, NCX and OPF files of books of `size` entries, with a stub kindlegen.'''
+    workdir = tempfile.mkdtemp()
+    try:
+        stub = os.path.join(workdir, 'kindlegen.sh')
+        with open(stub, 'w') as fo:
+            fo.write('#!/bin/sh\ntouch "$3"\n')
+        os.chmod(stub, 0755)
+        entries = [web.storage(feed_id=i / 20, feed_title='Feed %d' % (i / 20),
+                               entry_id=i, entry_title='Entry %d' % i,
+                               author=None, path='entries/%d.html' % i, digest=None)
+                   for i in range(size)]
+        kindlegen = KindleGen(stub)
+        make = lambda: kindlegen.execute('Bench', '2012-05-01', entries, workdir=workdir)
+        report(results, 'generate', 'mobi', size,
+               [best(make, 1) for i in range(runs(repeat, size))], size)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def isolated(fn, *args):
+    '''
+    Return results of `fn` called with a new result list after `args`,
+    in a child process, adding its peak RSS.
+    '''
+    sys.stdout.flush()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(rfd)
+            results = []
+            fn(*(args + (results,)))
+            # kilobytes on linux
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            for result in results:
+                result['peak_rss_kb'] = rss
+            print '%-8s %7s peak RSS %d KB' % ('', '', rss)
+            sys.stdout.flush()
+            with os.fdopen(wfd, 'w') as fo:
+                json.dump(results, fo)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(wfd)
+    with os.fdopen(rfd) as fi:
+        data = fi.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else []
+
+
+def commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    '''Print ratios of throughput and median latency to `baseline` results.'''
+    old = dict(((r['benchmark'], r['case'], r['size']), r) for r in baseline['results'])
+    print '== compare with', baseline.get('commit')
+    for r in results:
+        o = old.get((r['benchmark'], r['case'], r['size']))
+        if o:
+            print '%-8s %-8s %7d throughput x%5.2f  p50 x%5.2f' % (
+                r['benchmark'], r['case'], r['size'],
+                r['throughput'] / o['throughput'], r['p50_ms'] / (o['p50_ms'] or 1e-9))
+
+
+def benchConcurrency(repeat):
+    '''Read feed lists in threads while entries are saved, by journal mode.'''
+    from feed import FeedManager
+    import storage
+    import threading
+    # queries are not printed
+    web.config.debug = False
+    for journalMode in ('delete', 'wal'):
+        dirname = tempfile.mkdtemp()
+        try:
+            db = storage.database(os.path.join(dirname, 'bench.db'), journalMode=journalMode)
+            mgr = FeedManager(db, datapath=dirname)
+            for i in range(50):
+                db.insert('feed', url='http://example.com/%d' % i, title='Feed %d' % i)
+            running = [True]
+            latencies = []
+            errors = []
+            def read():
+                while running[0]:
+                    start = time.time()
+                    try:
+                        mgr.list(limit=15)
+                    except Exception as e:
+                        errors.append(e)
+                    latencies.append(time.time() - start)
+            readers = [threading.Thread(target=read) for i in range(4)]
+            for t in readers:
+                t.start()
+            stdout, sys.stdout = sys.stdout, StringIO()
+            start = time.time()
+            try:
+                for r in range(repeat):
+                    mgr._updateEntries(r % 50 + 1, [('http://example.com/%d/%d' % (r, i), 'Entry %d' % i,
+                                                     None, None, None, '<p>%d %d</p>' % (r, i))
+                                                    for i in range(200)])
+            finally:
+                sys.stdout = stdout
+                elapsed = time.time() - start
+                running[0] = False
+                for t in readers:
+                    t.join()
+            latencies.sort()
+            print '%-32s %-6s %8.2f ms %6d reads %8.2f ms max %d errors' % (
+                '%d x 200 entries' % repeat, journalMode, elapsed * 1000, len(latencies),
+                latencies[-1] * 1000 if latencies else 0, len(errors))
+        finally:
+            shutil.rmtree(dirname)
+
+
+BENCHMARKS = [
+    ('parse', benchParse),
+    ('clean', benchClean),
+    ('book', benchBook),
+    ('concurrency', benchConcurrency),
+    ]
+
+# benchmarks run for each size of corpus
+SCALED_BENCHMARKS = [
+    ('feeds', benchFeeds),
+    ('ingest', benchIngest),
+    ('paging', benchPaging),
+    ('generate', benchGenerate),
+    ]
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser('Usage: %prog [options] [benchmark ...]',
+                          description='Benchmarks: ' + ', '.join(n for n, fn in BENCHMARKS + SCALED_BENCHMARKS))
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=20,
+                      help='Times to run each case, best is reported [default: %default]')
+    parser.add_option('--sizes', dest='sizes', default='10,100,1000,10000',
+                      help='Comma separated entries or feeds of scaled benchmarks, up to 100000 [default: %default]')
+    parser.add_option('--json', dest='json',
+                      help='Save results of scaled benchmarks into this file')
+    parser.add_option('--compare', dest='compare',
+                      help='Compare results with those saved into this file')
+    options, args = parser.parse_args()
+
+    for name, fn in BENCHMARKS:
+        if not args or name in args:
+            print '==', name
+            fn(options.repeat)
+
+    results = []
+    sizes = [int(size) for size in options.sizes.split(',')]
+    for name, fn in SCALED_BENCHMARKS:
+        if not args or name in args:
+            print '==', name
+            for size in sizes:
+                results.extend(isolated(fn, options.repeat, size))
+
+    if options.json:
+        with open(options.json, 'w') as fo:
+            json.dump({'commit': commit(), 'time': int(time.time()),
+                       'python': sys.version.split()[0], 'sizes': sizes,
+                       'repeat': options.repeat, 'results': results},
+                      fo, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fi:
+            compare(results, json.load(fi))
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
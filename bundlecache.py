@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Cache of generated books, shared by accounts having the same unread entries.
+
+    >>> import tempfile, shutil
+    >>> dirname = tempfile.mkdtemp()
+    >>> cache = BundleCache(os.path.join(dirname, 'bundles'), maxBytes=10)
+    >>> key = cache.key('Feed2Mobi', '2012-05-01', [(1, 'a'), (2, 'b')])
+    >>> key == cache.key('Feed2Mobi', '2012-05-01', [(1, 'a'), (2, 'b')])
+    True
+    >>> key == cache.key('Feed2Mobi', '2012-05-01', [(2, 'b'), (1, 'a')])
+    False
+    >>> cache.get(key) is None
+    True
+    >>> book = os.path.join(dirname, 'book.mobi')
+    >>> with open(book, 'w') as fo:
+    ...     fo.write('123456')
+    >>> path = cache.put(key, book)
+    >>> cache.get(key) == path, os.path.exists(book)
+    (True, False)
+    >>> cache.get(key, '.epub') is None
+    True
+
+Least recently used books are evicted beyond `maxBytes`:
+
+    >>> other = cache.key('Feed2Mobi', '2012-05-02', [(3, 'c')])
+    >>> with open(book, 'w') as fo:
+    ...     fo.write('7890')
+    >>> os.utime(cache.put(other, book), (0, 0))
+    >>> cache.evict()
+    0
+    >>> with open(book, 'w') as fo:
+    ...     fo.write('1')
+    >>> path = cache.put(cache.key('Feed2Mobi', '2012-05-03', []), book)
+    >>> cache.evict()
+    1
+    >>> cache.get(other) is None, cache.get(key) is None
+    (True, False)
+    >>> shutil.rmtree(dirname)
+'''
+
+import hashlib
+import os
+import os.path
+
+
+class BundleCache(object):
+    '''
+    Keep books under `dirname` named by digest of their title, date and entries,
+    up to `maxBytes` in total.
+    '''
+
+    def __init__(self, dirname, maxBytes=256*1024*1024):
+        self._dirname = dirname
+        self._maxBytes = maxBytes
+
+
+    def key(self, title, date, entries):
+        '''
+        Return digest of book `title`, `date` and ordered `entries`,
+        as (entry id, content hash) tuples, so updated entries make
+        another book.
+        '''
+        sha1 = hashlib.sha1(title.encode('utf-8') + '\n' + date + '\n')
+        for entryId, contentHash in entries:
+            sha1.update('%s:%s\n' % (entryId, contentHash))
+        return sha1.hexdigest()
+
+
+    def _path(self, key, ext):
+        return os.path.join(self._dirname, key + ext)
+
+
+    def get(self, key, ext='.mobi'):
+        '''Return path of the book of `key` in format `ext`, or None if not cached.'''
+        path = self._path(key, ext)
+        try:
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+
+    def put(self, key, path):
+        '''Move book file `path` into the cache, return its new path.'''
+        if not os.path.exists(self._dirname):
+            try:
+                os.makedirs(self._dirname, 0755)
+            except OSError:
+                # made by another thread
+                pass
+        target = self._path(key, os.path.splitext(path)[1])
+        os.rename(path, target)
+        return target
+
+
+    def evict(self):
+        '''
+        Remove least recently used books beyond the size limit,
+        return count of removed books.
+        '''
+        if not os.path.exists(self._dirname):
+            return 0
+        books = []
+        for name in os.listdir(self._dirname):
+            path = os.path.join(self._dirname, name)
+            st = os.stat(path)
+            books.append((st.st_mtime, st.st_size, path))
+        books.sort(reverse=True)
+        total = 0
+        removed = 0
+        for mtime, size, path in books:
+            total += size
+            if total > self._maxBytes:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+In-process cache of values expiring after a time to live, evicting least
+recently used values beyond a maximum size.
+
+    >>> now = [0]
+    >>> cache = TtlCache(maxSize=4, ttl=10, clock=lambda: now[0])
+    >>> cache.get('top') is None
+    True
+    >>> cache.put('top', [1, 2, 3])
+    >>> cache.get('top')
+    [1, 2, 3]
+    >>> now[0] = 11
+    >>> cache.get('top', 'expired')
+    'expired'
+    >>> cache.hits, cache.misses, cache.hitRatio()
+    (1, 2, 0.3333333333333333)
+
+Least recently used values are dropped first when the cache is full:
+
+    >>> for key in 'abcd':
+    ...     cache.put(key, key)
+    >>> cache.get('a')
+    'a'
+    >>> cache.put('e', 'e')
+    >>> sorted(cache.keys())
+    ['a', 'c', 'd', 'e']
+    >>> cache.invalidate('a')
+    >>> sorted(cache.keys())
+    ['c', 'd', 'e']
+    >>> cache.invalidate()
+    >>> len(cache)
+    0
+'''
+
+import threading
+import time
+
+
+class TtlCache(object):
+    '''
+    Keep up to `maxSize` values for `ttl` seconds, shared by threads.
+    '''
+
+    def __init__(self, maxSize=1000, ttl=60, clock=time.time):
+        self._maxSize = maxSize
+        self._ttl = ttl
+        self._clock = clock
+        # key -> [expires at, last used tick, value]
+        self._items = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        '''Return value of `key`, or `default` if missing or expired.'''
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] <= self._clock():
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._tick += 1
+            item[1] = self._tick
+            return item[2]
+
+
+    def put(self, key, value):
+        with self._lock:
+            if key not in self._items and len(self._items) >= self._maxSize:
+                self._evict()
+            self._tick += 1
+            self._items[key] = [self._clock() + self._ttl, self._tick, value]
+
+
+    def _evict(self):
+        now = self._clock()
+        for key in [k for k, item in self._items.iteritems() if item[0] <= now]:
+            del self._items[key]
+        if len(self._items) >= self._maxSize:
+            # drop a quarter at once, not to sort on every put
+            items = sorted(self._items.iteritems(), key=lambda (k, item): item[1])
+            for key, item in items[:max(1, len(items) / 4)]:
+                del self._items[key]
+
+
+    def invalidate(self, key=None):
+        '''Drop value of `key`, or all values if `key` is None.'''
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+
+    def hitRatio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -2,9 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import hashlib
 import os
+import re
 
+import cache
 import feed
+import openidstore
+import runlog
+import sessionstore
+import storage
 import web
 import webopenid
 
@@ -25,8 +32,11 @@ web.config.debug = True
 # Webpy app instance
 app = web.auto_application()
 
-# Webpy database
-db = web.database(dbn='sqlite', db=os.path.join(datapath, 'feed2mobi.db'))
+# Webpy database, shared with cron jobs, see storage.database for tuning
+db = storage.database(os.path.join(datapath, 'feed2mobi.db'),
+                      journalMode='wal',
+                      synchronous='normal',
+                      busyTimeout=10.0)
 
 # Webpy template
 def pass_auth():
@@ -37,19 +47,34 @@ render = web.template.render(base='layout',
                              globals={'openid_form': webopenid.openid_form,
                                       'pass_auth': pass_auth})
 
+# Templates of page fragments, without layout
+partial = web.template.render()
+
+# Unread entries model, 'rows' or 'watermark', of the web app and of cron
+# jobs without --unread; switch to 'watermark' with
+# --migrate-unread --unread watermark, then set it here
+unread = 'rows'
+
 # Feed manager
-mgr = feed.FeedManager(db, datapath=datapath)
+mgr = feed.FeedManager(db, datapath=datapath, unread=unread)
+
+# Addresses allowed to read /metrics, /failures and /stats
+metrics_hosts = ('127.0.0.1', '::1')
+
+# Rendered feed rows by page, account of subscribed page, cursors and version
+fragments = cache.TtlCache(maxSize=500, ttl=600)
 
 
 # ----------------------------------------
 # OpenID service
 # ----------------------------------------
 web.config.session_parameters.cookie_name = "openid_session_id"
-session = web.session.Session(app, web.session.DiskStore('data/sessions'))
+# loaded for requests having a session cookie or logging in only
+session = webopenid.Session(app, sessionstore.SqliteStore(db))
 webopenid.session = session
 
-import openid.store.filestore
-webopenid.store = openid.store.filestore.FileOpenIDStore('data/store')
+# associations and nonces shared by processes, cleaned up by --compact
+webopenid.store = openidstore.SqliteOpenIDStore(db)
 
 app.add_mapping(r'/openid', 'webopenid.host')
 
@@ -80,49 +105,116 @@ def require_auth(fn):
 # Bizz web handlers
 # ----------------------------------------
 class top(app.page):
-    path='^/(?:top)?(?:\?o=[0-9]+)?$'
+    path='^/(?:top)?$'
     pagesize = 15
+    # numbers of a cursor, as returned by `cursor`
+    cursorsize = 2
+    SUBSCRIPTION_MARKER = re.compile(r'<!--subscription:([0-9]+)-->')
 
     def GET(self):
-        i = web.input()
-        offset = int(i.get('o', 0))
-        feeds = mgr.list(account=web.ctx.get('account_id'),
-                         offset=offset, limit=self.pagesize+1)
-        feeds, prevOffset, nextOffset = self.calcPageData(feeds, offset)
-        return render.list(feeds, prevOffset, nextOffset, self.page())
+        return self.render(mgr.list)
 
     def page(self):
         return ('top' if web.ctx.path=='/' else web.ctx.path[1:])
 
-    def calcPageData(self, feeds, offset):
-        return (feeds if len(feeds) <= self.pagesize else feeds[:-1],\
-                    None if offset == 0 else offset-self.pagesize,\
-                    None if len(feeds) <= self.pagesize else offset+self.pagesize)
+    def cursor(self, feed):
+        return (feed.account_count, feed.id)
+
+    def render(self, listFeeds, account=None):
+        """
+        Render a page of feeds listed by `listFeeds` for `account` after
+        cursor `a` or before cursor `b` of the query string, as dot joined
+        numbers.
+
+        Rendered rows are cached by page and version of feeds, only the
+        subscription links of the user are merged per request. Browsers
+        revalidate pages by their ETag.
+        """
+        i = web.input()
+        after = self.parseCursor(i.get('a'))
+        before = self.parseCursor(i.get('b'))
+        version = mgr.dataVersion()
+        web.header('Cache-Control', 'private, no-cache')
+        web.header('Vary', 'Cookie')
+        web.modified(etag=hashlib.sha1('%s %s %s %s' % (version,
+                                                        web.ctx.get('account_id'),
+                                                        web.ctx.get('account_actived'),
+                                                        web.ctx.fullpath)).hexdigest())
+        key = (self.page(), account, after, before, version)
+        fragment = fragments.get(key)
+        if fragment is None:
+            feeds = listFeeds(account, limit=self.pagesize+1, after=after, before=before)
+            feeds, prevCursor, nextCursor = self.calcPageData(feeds, after, before)
+            fragment = (unicode(partial.feeds(feeds)), [f.id for f in feeds],
+                        prevCursor, nextCursor)
+            fragments.put(key, fragment)
+        rows, feeds, prevCursor, nextCursor = fragment
+        return render.list(self.mergeSubscriptions(rows, feeds),
+                           prevCursor, nextCursor, self.page())
+
+    def subscriptions(self, feeds):
+        return mgr.subscribedFeeds(web.ctx.get('account_id'), feeds)
+
+    def mergeSubscriptions(self, rows, feeds):
+        """Replace markers in `rows` by subscription links of the user."""
+        if pass_auth():
+            subscribed = self.subscriptions(feeds)
+            link = lambda m: unicode(partial.subscription(m.group(1), int(m.group(1)) in subscribed))
+        else:
+            link = lambda m: u''
+        return self.SUBSCRIPTION_MARKER.sub(link, rows)
+
+    def parseCursor(self, value):
+        if not value:
+            return None
+        try:
+            cursor = tuple(int(v) for v in value.split('.'))
+        except ValueError:
+            raise web.badrequest()
+        if len(cursor) != self.cursorsize:
+            raise web.badrequest()
+        return cursor
+
+    def calcPageData(self, feeds, after, before):
+        more = len(feeds) > self.pagesize
+        if before:
+            feeds = feeds[1:] if more else feeds
+            hasPrev, hasNext = more, True
+        else:
+            feeds = feeds[:-1] if more else feeds
+            hasPrev, hasNext = bool(after), more
+        if not feeds:
+            return feeds, None, None
+        formatCursor = lambda feed: '.'.join(str(v) for v in self.cursor(feed))
+        return (feeds,
+                formatCursor(feeds[0]) if hasPrev else None,
+                formatCursor(feeds[-1]) if hasNext else None)
 
 
 class new(top):
-    path='^/new(?:\?o=[0-9]+)?$'
+    path='^/new$'
+    cursorsize = 1
 
     def GET(self):
-        i = web.input()
-        offset = int(i.get('o', 0))
-        feeds = mgr.listNew(web.ctx.get('account_id'),
-                            offset=offset, limit=self.pagesize+1)
-        feeds, prevOffset, nextOffset = self.calcPageData(feeds, offset)
-        return render.list(feeds, prevOffset, nextOffset, self.page())
+        return self.render(mgr.listNew)
+
+    def cursor(self, feed):
+        return (feed.id,)
 
 
 class subscribed(top):
-    path='^/subscribed(?:\?o=[0-9]+)?$'
+    path='^/subscribed$'
+    cursorsize = 1
 
     @require_auth
     def GET(self):
-        i = web.input()
-        offset = int(i.get('o', 0))
-        feeds = mgr.listSubscribed(web.ctx.get('account_id'),
-                                   offset=offset, limit=self.pagesize+1)
-        feeds, prevOffset, nextOffset = self.calcPageData(feeds, offset)
-        return render.list(feeds, prevOffset, nextOffset, self.page())
+        return self.render(mgr.listSubscribed, web.ctx.get('account_id'))
+
+    def cursor(self, feed):
+        return (feed.subscribed,)
+
+    def subscriptions(self, feeds):
+        return set(feeds)
 
 
 class subscribe(app.page):
@@ -173,16 +265,52 @@ class delivery(app.page):
         if address:
             address = address.strip()
 
-        db.update('account',
-                  where='id=$account',
-                  delivery_actived = actived,
-                  delivery_hour = hour,
-                  delivery_address = address,
-                  delivery_bundle = bundle,
-                  vars={'account': web.ctx.get('account_id')})
+        mgr.updateAccount(web.ctx.get('account_id'),
+                          delivery_actived = actived,
+                          delivery_hour = hour,
+                          delivery_address = address,
+                          delivery_bundle = bundle)
         raise web.seeother(web.ctx.home + web.http.url('/delivery'))
 
 
+class metrics(app.page):
+    '''Metrics of update, kindlegen and deliver runs for Prometheus.'''
+
+    def GET(self):
+        if web.ctx.ip not in metrics_hosts:
+            raise web.forbidden()
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return runlog.exposition(db)
+
+
+class failures(app.page):
+    '''Feeds spending most time in failed fetches.'''
+
+    def GET(self):
+        if web.ctx.ip not in metrics_hosts:
+            raise web.forbidden()
+        web.header('Content-Type', 'text/plain; charset=utf-8')
+        return ''.join(failureLine(f) + '\n' for f in mgr.failureReport())
+
+
+def failureLine(f):
+    return '%8.1fs %4d failures %3d in a row %-8s feed#%d %s  %s' % (
+        f.seconds, f.failures, f.failure_count, 'active' if f.actived else 'inactive',
+        f.id, f.url, f.last_error)
+
+
+class stats(app.page):
+    '''Hit ratios of in-process caches, per process.'''
+
+    def GET(self):
+        if web.ctx.ip not in metrics_hosts:
+            raise web.forbidden()
+        web.header('Content-Type', 'text/plain')
+        caches = [('accounts', mgr.accountCache()), ('fragments', fragments)]
+        return ''.join('%s %d hits %d misses %.3f hit ratio\n'
+                       % (name, c.hits, c.misses, c.hitRatio()) for name, c in caches)
+
+
 
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -190,18 +318,81 @@ if __name__ == '__main__':
     parser.add_option('--update', dest='update', action='store_true',
                       help='Update contents of feeds')
     parser.add_option('--kindlegen', dest='kindlegen', action='store_true',
-                      help='Run kindlegen and send files')
+                      help='Build books and queue them for --deliver')
+    parser.add_option('--deliver', dest='deliver', action='store_true',
+                      help='Send queued books by mail')
+    parser.add_option('--smtp-host', dest='smtpHost', default='127.0.0.1',
+                      help='SMTP server sending books [default: %default]')
+    parser.add_option('--smtp-port', dest='smtpPort', type='int', default=25,
+                      help='Port of SMTP server [default: %default]')
+    parser.add_option('--unread', dest='unread', choices=['rows', 'watermark'], default=unread,
+                      help='Unread entries model [default: %default]')
+    parser.add_option('--migrate-unread', dest='migrateUnread', action='store_true',
+                      help='Convert unread rows into read marks of subscriptions, with --unread watermark')
+    parser.add_option('--compact', dest='compact', action='store_true',
+                      help='Delete old entries, their files and read marks, and reclaim space')
+    parser.add_option('--keep-days', dest='readDays', type='int', default=30,
+                      help='Days to keep read entries, unless set for their feed [default: %default]')
+    parser.add_option('--keep-unread-days', dest='unreadDays', type='int', default=90,
+                      help='Days to keep unread entries [default: %default]')
+    parser.add_option('--keep-log-days', dest='logDays', type='int', default=14,
+                      help='Days to keep the run log, with --compact [default: %default]')
+    parser.add_option('--vacuum', dest='vacuum', action='store_true',
+                      help='Rebuild the database once to enable incremental vacuum, with --compact')
+    parser.add_option('--format', dest='format', choices=['mobi', 'epub'], default='mobi',
+                      help='Book format, epub is written without kindlegen [default: %default]')
+    parser.add_option('--workers', dest='workers', type='int', default=4,
+                      help='Number of threads fetching feeds or building books [default: %default]')
+    parser.add_option('--host-limit', dest='hostLimit', type='int', default=2,
+                      help='Max concurrent fetches per host [default: %default]')
+    parser.add_option('--deadline', dest='deadline', type='float',
+                      help='Seconds to give up fetching the remaining feeds')
+    parser.add_option('--streaming', dest='streaming', action='store_true',
+                      help='Parse feeds incrementally, stop at saved entries')
+    parser.add_option('--all', dest='force', action='store_true',
+                      help='Fetch all active feeds, not only those due by schedule')
+    parser.add_option('--failures', dest='failures', action='store_true',
+                      help='Report feeds spending most time in failed fetches')
+    parser.add_option('--failure-days', dest='failureDays', type='int', default=7,
+                      help='Days of fetches reported by --failures [default: %default]')
+    parser.add_option('--reactivate', dest='reactivate', type='int', metavar='FEED',
+                      help='Activate feed given up after failures')
     options, args = parser.parse_args()
-
-    if options.update or options.kindlegen:
-        if options.update:
-            mgr.update()
+    if options.unread != unread:
+        mgr = feed.FeedManager(db, datapath=datapath, unread=options.unread)
+
+    if options.update or options.kindlegen or options.deliver or options.compact \
+            or options.migrateUnread or options.failures or options.reactivate:
+        if options.failures:
+            for f in mgr.failureReport(days=options.failureDays):
+                print failureLine(f).encode('utf-8')
+        elif options.reactivate:
+            print '%d feeds reactivated' % mgr.reactivate(options.reactivate)
+        elif options.migrateUnread:
+            if options.unread != 'watermark':
+                parser.error('--migrate-unread switches to --unread watermark')
+            mgr.migrateUnread()
+        elif options.deliver:
+            from mailer import SmtpMailer
+            mgr.deliver(SmtpMailer(options.smtpHost, options.smtpPort))
+        elif options.compact:
+            mgr.compact(readDays=options.readDays,
+                        unreadDays=options.unreadDays,
+                        vacuum=options.vacuum)
+            print '%d expired nonces, %d expired associations' % webopenid.store.cleanup()
+            print '%d run log rows deleted' % runlog.expire(db, options.logDays)
+        elif options.update:
+            mgr.update(workers=options.workers,
+                       hostLimit=options.hostLimit,
+                       deadline=options.deadline,
+                       streaming=options.streaming,
+                       force=options.force)
         else:
             # cron job always runs before delivery hour
             hour = datetime.datetime.now().hour + 1
             if hour > 23:
                 hour = 0
-            mgr.kindlegen(hour)
+            mgr.kindlegen(hour, workers=options.workers, format=options.format)
     else:
         app.run()
 
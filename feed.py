@@ -2,34 +2,31 @@
 
 import datetime
 import hashlib
-import itertools
 import os
 import os.path
+import shutil
 import sqlite3
 import sys
+import tempfile
+import time
 
+import runlog
+import sanitizer
 
+from bundlecache import BundleCache
+from cache import TtlCache
+from httpclient import HttpClient
 from kindlegen import KindleGen, htmlNode
 from lxml import etree
-from subprocess import call, Popen, PIPE
 from urllib2 import urlopen, Request, HTTPError
+from urlparse import urlparse
 from StringIO import StringIO
-
-
-def cd(path):
-    class ChangeDir(object):
-        def __init__(self, path):
-            self._path = path
-        def __enter__(self):
-            self._oldpath = os.getcwd()
-            os.chdir(self._path)
-        def __exit__(self, exc_type, exc_value, traceback):
-            os.chdir(self._oldpath)
-    return ChangeDir(path)
+from scheduler import FeedScheduler
+from store import PackStore
+from workers import DeadlineExceeded, WorkerPool
 
 
 def normalize_url(url):
-    from urlparse import urlparse
     from urllib import pathname2url
 
     o = urlparse(url)
@@ -44,37 +41,89 @@ class FeedFactory(object):
     _feedTypes=[]
 
     @classmethod
-    def parseFeed(cls, url, lastModified=None, etag=None):
+    def fetch(cls, url, lastModified=None, etag=None, timeout=10, http=None,
+              info=None):
         '''
-        Return tuple of feed object, last-modified, etag.
+        Return tuple of feed document, last-modified, etag,
+        or None if feed is not modified. Raise IOError of HTTP errors.
+
+        HTTP urls are fetched by HttpClient `http` if given. HTTP status
+        and length of the document are set in dict `info` if given.
         '''
-        req = Request(normalize_url(url))
+        headers = {}
         if lastModified:
-            req.add_header('if-modified-since', lastModified)
+            headers['If-Modified-Since'] = lastModified
         if etag:
-            req.add_header('if-none-match', etag)
-        resp = None
-        try:
-            resp = urlopen(req, None, 10)
-        except HTTPError as error:
-            # HTTP 304 not modifed raise an exception
-            resp = error
+            headers['If-None-Match'] = etag
 
-        # url of local file returns empty code
+        url = normalize_url(url)
+        if http and urlparse(url).scheme in ('http', 'https'):
+            resp = http.get(url, headers, timeout)
+        else:
+            req = Request(url, headers=headers)
+            resp = None
+            try:
+                resp = urlopen(req, None, timeout)
+            except HTTPError as error:
+                # HTTP 304 not modifed raise an exception
+                resp = error
+
+        if info is not None:
+            # url of local file returns empty code
+            info['status'] = resp.code or 200
+        if resp.code and resp.code >= 400:
+            raise IOError('HTTP status %d' % (resp.code,))
         if resp.code and resp.code != 200:
             return None
 
-        feedDoc = etree.parse(resp)
+        body = resp.read()
+        if info is not None:
+            info['bytes'] = len(body)
+        return (body,
+                resp.headers.get('last-modified'),
+                resp.headers.get('etag'))
+
+    @classmethod
+    def parse(cls, url, body, streaming=False):
+        '''
+        Return feed object of document `body`.
+
+        With `streaming`, return a StreamFeed which parses items while
+        they are iterated instead of building the whole document tree;
+        it must be used in the thread calling this method.
+        '''
+        if streaming:
+            # line ends are normalized as XML requires, the push parser
+            # misses CRLF split across its chunks
+            events = etree.iterparse(StringIO(body.replace('\r\n', '\n')),
+                                     events=('start', 'end'))
+            action, feedDoc = next(events)
+        else:
+            feedDoc = etree.parse(StringIO(body))
         feedType = None
         for ft in cls._feedTypes:
-            if ft.accept(feedDoc):
+            if ft.streaming == streaming and ft.accept(feedDoc):
                 feedType = ft
                 break
         if not feedType:
-            raise ValueError('Cannot handle ' + feedDoc.getroot().tag)
-        return (feedType(url, feedDoc),
-                resp.headers.get('last-modified'),
-                resp.headers.get('etag'))
+            raise ValueError('Cannot handle ' + (feedDoc.tag if streaming
+                                                 else feedDoc.getroot().tag))
+        if streaming:
+            return feedType(url, events, feedDoc)
+        else:
+            return feedType(url, feedDoc)
+
+    @classmethod
+    def parseFeed(cls, url, lastModified=None, etag=None, timeout=10,
+                  streaming=False):
+        '''
+        Return tuple of feed object, last-modified, etag.
+        '''
+        fetched = cls.fetch(url, lastModified, etag, timeout)
+        if not fetched:
+            return None
+        body, lastModified, etag = fetched
+        return (cls.parse(url, body, streaming), lastModified, etag)
 
     @classmethod
     def register(cls, feedType):
@@ -84,6 +133,7 @@ class FeedFactory(object):
 class Feed(object):
 
     _NSS = {}
+    streaming = False
 
     @classmethod
     def accept(cls, feedDoc):
@@ -132,8 +182,11 @@ class Feed(object):
         '''Return last updated date/timestamp str.'''
         raise NotImplemented
 
-    def items(self):
-        '''Return iterator of tuple (url, title, author, pubdate, summary, content).'''
+    def items(self, known=()):
+        '''
+        Return iterator of tuple (url, title, author, pubdate, summary, content).
+        Stop at the first item whose url is in `known`.
+        '''
         raise NotImplemented
 
 
@@ -165,7 +218,7 @@ class Rss2Feed(Feed):
         nodes = self.doc().xpath('/rss/channel/lastBuildDate/text()')
         return nodes[0] if len(nodes) > 0 else None
 
-    def items(self):
+    def items(self, known=()):
         for item in self.doc().xpath('/rss/channel/item'):
             url = self._text(item, 'link', 'guid')
             title = self._text(item, 'title')
@@ -179,6 +232,8 @@ class Rss2Feed(Feed):
                     continue
                 else:
                     url = hashlib.sha1(title.encode('utf-8')).hexdigest()
+            if url in known:
+                return
             yield (url, title, author, pubdate, summary, content)
 
 
@@ -212,7 +267,7 @@ class AtomFeed(Feed):
                                  namespaces=self._NSS)
         return nodes[0] if len(nodes) > 0 else None
 
-    def items(self):
+    def items(self, known=()):
         feedBase = self.doc().getroot().attrib.get(self._XMLBASE, '')
         if feedBase:
             path = feedBase.split('/')
@@ -240,13 +295,270 @@ class AtomFeed(Feed):
                     continue
                 else:
                     url = hashlib.sha1(title.encode('utf-8')).hexdigest()
+            if url in known:
+                return
 
             yield (url, title, author if author else feedAuthor,
                    pubdate, summary, content)
 
 
+class StreamFeed(Feed):
+    '''
+    Feed parsed by `etree.iterparse` while its items are iterated, each item
+    element is cleared after use, so memory doesn't grow with the feed size.
+    Feed fields are read ahead up to the first item, `items()` can be
+    iterated only once.
+
+    Stream feeds give the same results as tree feeds, except inline xhtml
+    content may escape non-ascii chars of attributes as char references:
+
+        >>> def rendered(entry):
+        ...     return entry[:5] + (etree.tostring(etree.HTML(entry[5])) if entry[5] else None,)
+        >>> for name in sorted(os.listdir('samples')):
+        ...     tree = FeedFactory.parseFeed('samples/' + name)[0]
+        ...     stream = FeedFactory.parseFeed('samples/' + name, streaming=True)[0]
+        ...     heads = [(f.title(), f.description(), f.lastUpdated()) for f in (tree, stream)]
+        ...     print name, stream.__class__.__name__, heads[0] == heads[1], \\
+        ...         map(rendered, tree.items()) == map(rendered, stream.items())
+        emacsen.atom.xml AtomStreamFeed True True
+        ifanr.rss2.xml Rss2StreamFeed True True
+        ongoing.atom.xml AtomStreamFeed True True
+        planet_python.rss2.xml Rss2StreamFeed True True
+
+    Parsing stops at the first known item:
+
+        >>> stream = FeedFactory.parseFeed('samples/ifanr.rss2.xml', streaming=True)[0]
+        >>> len(list(stream.items(known=['http://www.ifanr.com/48219'])))
+        3
+    '''
+
+    streaming = True
+    _ITEM = None
+    _HEAD = {}
+
+    @classmethod
+    def accept(cls, root):
+        '''Return True if this feed impl can handle document of root element, otherwise False.'''
+        raise NotImplemented
+
+    def __init__(self, url, events, root):
+        Feed.__init__(self, url, None)
+        self._events = events
+        self._root = root
+        self._head = {}
+        for action, node in events:
+            if action == 'start':
+                if node.tag == self._ITEM:
+                    break
+            else:
+                self._readHead(node)
+
+    def _readHead(self, node):
+        parent = node.getparent()
+        if parent is not None:
+            field = self._HEAD.get((parent.tag, node.tag))
+            if field and node.text and field not in self._head:
+                self._head[field] = node.text
+
+    def _find(self, node, *paths):
+        for path in paths:
+            n = node.find(path)
+            if n is not None:
+                if 'xhtml' == n.attrib.get('type') and len(n):
+                    return etree.tostring(n[0],
+                                          pretty_print=False,
+                                          encoding='utf-8',
+                                          xml_declaration=False).decode('utf-8')
+                else:
+                    if n.text:
+                        return n.text
+
+    def _entry(self, item):
+        '''Return tuple (url, title, author, pubdate, summary, content) of item element.'''
+        raise NotImplemented
+
+    def title(self):
+        return self._head.get('title') or self.url().split('/')[2]
+
+    def description(self):
+        return self._head.get('description')
+
+    def lastUpdated(self):
+        return self._head.get('lastUpdated')
+
+    def items(self, known=()):
+        for action, node in self._events:
+            if action == 'start':
+                continue
+            if node.tag != self._ITEM:
+                self._readHead(node)
+                continue
+            entry = self._entry(node)
+            # drop parsed item and its preceding siblings
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+            if entry is None:
+                continue
+            if entry[0] in known:
+                return
+            yield entry
+
+
+class Rss2StreamFeed(StreamFeed):
+
+    _CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+    _DC = '{http://purl.org/dc/elements/1.1/}'
+    _ITEM = 'item'
+    _HEAD = {
+        ('channel', 'title'): 'title',
+        ('channel', 'description'): 'description',
+        ('channel', 'lastBuildDate'): 'lastUpdated',
+        }
+
+    @classmethod
+    def accept(cls, root):
+        return ('rss' == root.tag and
+                '2.0' == root.attrib.get('version'))
+
+    def _entry(self, item):
+        url = self._find(item, 'link', 'guid')
+        title = self._find(item, 'title')
+        author = self._find(item, self._DC + 'creator')
+        pubdate = self._find(item, 'pubDate')
+        summary = self._find(item, 'description')
+        content = self._find(item, self._CONTENT + 'encoded')
+
+        if url is None:
+            if title is None:
+                return None
+            else:
+                url = hashlib.sha1(title.encode('utf-8')).hexdigest()
+        return (url, title, author, pubdate, summary, content)
+
+
+class AtomStreamFeed(StreamFeed):
+
+    _A = '{http://www.w3.org/2005/Atom}'
+    _XMLBASE = AtomFeed._XMLBASE
+    _ITEM = _A + 'entry'
+    _HEAD = {
+        (_A + 'feed', _A + 'title'): 'title',
+        (_A + 'feed', _A + 'subtitle'): 'description',
+        (_A + 'feed', _A + 'updated'): 'lastUpdated',
+        (_A + 'author', _A + 'name'): 'author',
+        }
+
+    @classmethod
+    def accept(cls, root):
+        return cls._A + 'feed' == root.tag
+
+    def __init__(self, url, events, root):
+        feedBase = root.attrib.get(self._XMLBASE, '')
+        if feedBase:
+            path = feedBase.split('/')
+            if len(path) == 3: # http://host:port
+                feedBase = '/'.join(path) + '/'
+            else:
+                path[-1] = ''
+                feedBase = '/'.join(path)
+        self._feedBase = feedBase
+        StreamFeed.__init__(self, url, events, root)
+
+    def _readHead(self, node):
+        if node.tag == self._A + 'name':
+            # only name of feed author, not of entry authors
+            author = node.getparent()
+            if author.getparent() is not self._root:
+                return
+        StreamFeed._readHead(self, node)
+
+    def _entry(self, item):
+        A = self._A
+        entryBase = item.attrib.get(self._XMLBASE, '')
+        links = item.findall(A + 'link')
+        link = [l for l in links if 'rel' not in l.attrib] or links
+        link = link[0].attrib['href']
+        url = ''.join([self._feedBase, entryBase, link])
+        title = self._find(item, A + 'title')
+        author = [n.text for n in item.findall(A + 'author/' + A + 'name') if n.text]
+        pubdate = self._find(item, A + 'updated', A + 'published')
+        summary = self._find(item, A + 'summary')
+        content = self._find(item, A + 'content')
+
+        if url is None:
+            if title is None:
+                return None
+            else:
+                url = hashlib.sha1(title.encode('utf-8')).hexdigest()
+
+        return (url, title, ', '.join(author) if author else self._head.get('author'),
+                pubdate, summary, content)
+
+
 FeedFactory.register(Rss2Feed)
 FeedFactory.register(AtomFeed)
+FeedFactory.register(Rss2StreamFeed)
+FeedFactory.register(AtomStreamFeed)
+
+
+class _UnreadEntries(object):
+    '''
+    Unread entries of an account up to entry `maxId`, with path and digest
+    of their contents in `store`, and without the same contents of other
+    feeds. Entries are queried again on each iteration, not kept in memory.
+
+    `unreadSql` selects ids of the unread entries of $account_id up to $max_id.
+    '''
+
+    def __init__(self, db, store, unreadSql, accountId, count, maxId):
+        self._db = db
+        self._store = store
+        self._unreadSql = unreadSql
+        self._accountId = accountId
+        self._count = count
+        self.maxId = maxId
+
+
+    @classmethod
+    def forAccount(cls, db, store, unreadSql, accountId):
+        '''
+        Return unread entries of account `accountId` saved by now, counted
+        once per content as they are iterated.
+        '''
+        unread = db.query('''
+SELECT count(DISTINCT ifnull(content_hash, id)) count, max(id) max_id
+FROM entry WHERE id IN (%s)''' % (unreadSql,), vars={'account_id': accountId, 'max_id': sys.maxint})[0]
+        return cls(db, store, unreadSql, accountId, unread.count, unread.max_id)
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __iter__(self):
+        for entry in self._db.query('''
+SELECT entry.feed_id,
+ feed.title feed_title,
+ entry.id entry_id,
+ entry.title entry_title,
+ entry.author,
+ entry.path,
+ entry.content_hash,
+ (SELECT 1 FROM blob WHERE blob.digest=entry.content_hash) stored
+FROM entry, feed
+WHERE entry.id IN (
+  SELECT min(e.id) FROM entry e
+  WHERE e.id IN (%s)
+  GROUP BY ifnull(e.content_hash, e.id))
+ AND feed.id=entry.feed_id
+ORDER BY entry.feed_id ASC, entry.id ASC
+''' % (self._unreadSql,), vars={'account_id': self._accountId, 'max_id': self.maxId}):
+            # entries saved before the store have their own files
+            entry.digest = entry.content_hash if entry.stored else None
+            if entry.digest:
+                entry.path = self._store.path(entry.digest)
+            yield entry
 
 
 class FeedManager(object):
@@ -254,10 +566,11 @@ class FeedManager(object):
     Manage user accounts and feed subscription.
 
         >>> import os
-        >>> os.makedirs('data')
+        >>> if not os.path.isdir('data'):
+        ...     os.makedirs('data')
         >>> import web
         >>> db = web.database(dbn='sqlite', db='data/feed2mobi.db')
-        >>> mgr = FeedManager(db)
+        >>> mgr = FeedManager(db, datapath='data')
         >>> mgr.list()
         []
         >>> mgr.account('tom@example.com')
@@ -268,6 +581,12 @@ class FeedManager(object):
         (2, 1)
         >>> mgr.account('john@example.com')
         (3, 1)
+        >>> mgr.account('tom@example.com'), mgr.accountCache().hits
+        ((1, 1), 2)
+        >>> mgr.updateAccount(3, actived=0)
+        >>> mgr.account('john@example.com')
+        (3, 0)
+        >>> mgr.updateAccount(3, actived=1)
         >>> mgr.list()
         []
         >>> mgr.subscribe('samples/ifanr.rss2.xml', 1)
@@ -285,8 +604,12 @@ class FeedManager(object):
         1
         >>> feeds[0].account_count
         2
-        >>> len(mgr.list(limit=1, offset=0))
-        1
+        >>> [f.id for f in mgr.list(limit=1, after=(2, 1))]
+        [2]
+        >>> [f.id for f in mgr.list(limit=1, before=(1, 2))]
+        [1]
+        >>> [f.id for f in mgr.listNew(limit=1, after=(2,))]
+        [1]
         >>> mgr.unsubscribe(2, 2)
         >>> feeds = mgr.list()
         >>> len(feeds)
@@ -295,10 +618,353 @@ class FeedManager(object):
         2
         >>> feeds[1].account_count
         0
+        >>> [(f.id, bool(f.subscribed)) for f in mgr.list(account=2)]
+        [(1, True), (2, False)]
+        >>> mgr.subscribedFeeds(2, [1, 2]), mgr.subscribedFeeds(2, [])
+        (set([1]), set([]))
+        >>> version = mgr.dataVersion()
+        >>> mgr.subscribe(2, 2)
+        (2, 2)
+        >>> mgr.unsubscribe(2, 2)
+        >>> mgr.dataVersion() - version
+        2
         >>> len(mgr.listSubscribed(1))
         1
         >>> mgr.listSubscribed(3)
         []
+
+    Subscriber counts of tables created by older versions are counted once:
+
+        >>> olddb = web.database(dbn='sqlite', db='data/old.db')
+        >>> _ = olddb.query('CREATE TABLE feed (id INTEGER PRIMARY KEY, url TEXT, title TEXT, description TEXT, actived INTEGER)')
+        >>> _ = olddb.query('CREATE TABLE account_feed (id INTEGER PRIMARY KEY, account_id INTEGER, feed_id INTEGER)')
+        >>> _ = olddb.query("INSERT INTO feed VALUES (1, 'a', 'A', '', 1)")
+        >>> _ = olddb.query("INSERT INTO feed VALUES (2, 'b', 'B', '', 1)")
+        >>> _ = olddb.query('INSERT INTO account_feed VALUES (1, 1, 2)')
+        >>> _ = olddb.query('CREATE TABLE entry (id INTEGER PRIMARY KEY, feed_id INTEGER, path TEXT, link TEXT, title TEXT, author TEXT, pub_date TEXT)')
+        >>> _ = olddb.query("INSERT INTO entry VALUES (1, 2, 'p', 'l', 'T', NULL, NULL)")
+        >>> [(f.id, f.account_count) for f in FeedManager(olddb, datapath='data').list()]
+        [(2, 1), (1, 0)]
+
+    And their entries are retained from the upgrade on:
+
+        >>> [e.fetched_at >= int(time.time()) - 60 for e in olddb.select('entry')]
+        [True]
+
+    Fetch feeds concurrently from a slow server, but save entries in one thread:
+
+        >>> import sys, time, StringIO
+        >>> from testserver import SampleServer
+        >>> server = SampleServer(delay=0.3).start()
+        >>> mgr.subscribe(server.url('emacsen.atom.xml'), 3)
+        (3, 3)
+        >>> mgr.subscribe(server.url('planet_python.rss2.xml'), 3)
+        (4, 3)
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> start = time.time()
+        >>> mgr.update(workers=4)
+        >>> elapsed = time.time() - start
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> log.count('>>>'), 'Error' in log, elapsed < 2 * 0.3
+        (4, False, True)
+        >>> [(e.feed_id, e.c) for e in db.query('SELECT feed_id, count(*) c FROM entry GROUP BY feed_id')]
+        [(1, 10), (2, 14), (3, 30), (4, 25)]
+
+    Feeds not modified are not transferred again:
+
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.update(workers=1, force=True)
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> print log.splitlines()[-1]
+        2 requests, 1 connections, 1 reused, 0 bytes received, 0 bytes decoded
+
+    Feeds are not fetched before they are due:
+
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.update()
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> print log
+        0 of 0 due feeds fetched
+        0 feeds failed, 0 deactivated
+        0 unchanged entries not rewritten
+        0 requests, 0 connections, 0 reused, 0 bytes received, 0 bytes decoded
+        <BLANKLINE>
+        >>> db.update('feed', where='id=3', next_fetch_at=0)
+        1
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.update()
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> log.count('>>>'), [(f.unchanged_count, f.fetch_interval) for f in db.select('feed', where='id=3')]
+        (1, [(2, 1800)])
+
+    Failing feeds are tried again later and later, then given up:
+
+        >>> from scheduler import FeedScheduler
+        >>> gone = db.insert('feed', url=server.url('missing.xml'), title='Gone')
+        >>> strict = FeedManager(db, datapath='data',
+        ...                      scheduler=FeedScheduler(jitter=0, retries=0, maxFailures=2))
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> strict.update()
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> [f.next_fetch_at - int(time.time()) > 1800 for f in db.select('feed', where='id=$gone', vars=locals())]
+        [True]
+        >>> db.update('feed', where='id=$gone', vars=locals(), next_fetch_at=0)
+        1
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> strict.update()
+        >>> sys.stdout, log = stdout, log + sys.stdout.getvalue()
+        >>> print '\\n'.join(l for l in log.splitlines() if 'failed' in l or 'Error' in l)
+        Error when fetching and parsing feed, IOError: HTTP status 404
+        1 feeds failed, 0 deactivated
+        Error when fetching and parsing feed, IOError: HTTP status 404
+        1 feeds failed, 1 deactivated
+        >>> [(f.actived, f.failure_count, f.last_error) for f in db.select('feed', where='id=$gone', vars=locals())]
+        [(0, 2, u'IOError: HTTP status 404')]
+        >>> [(f.id == gone, f.failures, f.seconds < 1) for f in mgr.failureReport()]
+        [(True, 2, True)]
+        >>> mgr.reactivate(gone)
+        1
+        >>> db.delete('feed', where='id=$gone', vars=locals())
+        1
+        >>> server.stop()
+
+    Entries are rewritten only when their content changes:
+
+        >>> entry = (u'http://example.com/1', u'Hello', None, u'Mon', None, u'<p>Hello  world</p>')
+        >>> mgr._updateEntries(1, [entry]) # doctest: +ELLIPSIS
+            1 new, 0 updated, 0 not rewritten, ...
+        (1, 0, 0)
+        >>> mgr._updateEntries(1, [entry[:3] + (u'Tue', None, u'<p>Hello world</p>')]) # doctest: +ELLIPSIS
+            0 new, 0 updated, 1 not rewritten, ...
+        (0, 0, 1)
+        >>> mgr._updateEntries(1, [entry[:3] + (u'Tue', None, u'<p>Hello world</p>')]) # doctest: +ELLIPSIS
+            0 new, 0 updated, 0 not rewritten, ...
+        (0, 0, 0)
+        >>> [e.pub_date for e in db.select('entry', where='link=$link', vars={'link': entry[0]})]
+        [u'Tue']
+        >>> mgr._updateEntries(1, [entry[:3] + (u'Tue', None, u'<p>Hello feeds</p>')]) # doctest: +ELLIPSIS
+            0 new, 1 updated, 0 not rewritten, ...
+        (0, 1, 0)
+
+    Contents are stored once for all feeds, and removed with the last entry
+    referring to them:
+
+        >>> mgr._updateEntries(2, [entry[:3] + (u'Tue', None, u'<p>Hello feeds</p>')]) # doctest: +ELLIPSIS
+            1 new, 0 updated, 0 not rewritten, ...
+        (1, 0, 0)
+        >>> [(e.feed_id, e.stored) for e in db.query('SELECT feed_id, content_hash, (SELECT count(*) FROM blob WHERE digest=content_hash) stored FROM entry WHERE link=$link', vars={'link': entry[0]})]
+        [(1, 1), (2, 1)]
+        >>> len(set(e.content_hash for e in db.select('entry', where='link=$link', vars={'link': entry[0]})))
+        1
+        >>> digest = mgr._contentHash(u'Hello', u'<p>Hello feeds</p>')
+        >>> mgr._updateEntries(1, [entry[:3] + (u'Wed', None, u'<p>Bye</p>')]) # doctest: +ELLIPSIS
+            0 new, 1 updated, 0 not rewritten, ...
+        (0, 1, 0)
+        >>> digest in mgr._store
+        True
+        >>> mgr._updateEntries(2, [entry[:3] + (u'Wed', None, u'<p>Bye</p>')]) # doctest: +ELLIPSIS
+            0 new, 1 updated, 0 not rewritten, ...
+        (0, 1, 0)
+        >>> digest in mgr._store
+        False
+
+    Books are built at once, each in its own directory, and once for
+    accounts having the same unread entries:
+
+        >>> stub = os.path.abspath('data/kindlegen.sh')
+        >>> with open(stub, 'w') as fo:
+        ...     fo.write('#!/bin/sh\\nsleep 0.3\\ntouch "$3"\\n')
+        >>> os.chmod(stub, 0755)
+        >>> db.update('account', where='1=1', delivery_actived=1, delivery_hour=5,
+        ...           delivery_bundle=0, delivery_address='kindle@example.com')
+        3
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> start = time.time()
+        >>> mgr.kindlegen(5, workers=3, program=stub)
+        >>> elapsed = time.time() - start
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> log.count('kindle@example.com:'), 'Error' in log, elapsed < 3 * 0.3
+        (3, False, True)
+        >>> print log.splitlines()[-1] # doctest: +ELLIPSIS
+        3 accounts, 2 books, 2 built, 3 queued, 0 evicted, ...
+        >>> [(d.account_id, d.max_id > 0) for d in db.select('delivery')]
+        [(1, True), (2, True), (3, True)]
+        >>> db.query('SELECT count(*) c FROM account_entry WHERE unread=0')[0].c
+        0
+        >>> [name for name in os.listdir('data') if name.startswith('kindlegen-')]
+        []
+        >>> db.update('account_entry', where='1=1', unread=1) > 0
+        True
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.kindlegen(5, workers=3, program=stub)
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> print log.splitlines()[-1] # doctest: +ELLIPSIS
+        3 accounts, 2 books, 0 built, 3 queued, 0 evicted, ...
+
+    Or written as .epub files, without kindlegen:
+
+        >>> import zipfile
+        >>> db.update('account_entry', where='1=1', unread=1) > 0
+        True
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.kindlegen(5, workers=3, format='epub')
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> print log.splitlines()[-1] # doctest: +ELLIPSIS
+        3 accounts, 2 books, 2 built, 3 queued, 0 evicted, ...
+        >>> books = [name for name in os.listdir('data/bundles') if name.endswith('.epub')]
+        >>> epub = zipfile.ZipFile(os.path.join('data/bundles', books[0]))
+        >>> epub.namelist()[:5]
+        ['mimetype', 'META-INF/container.xml', 'periodical.opf', 'periodical.ncx', 'periodical.html']
+        >>> epub.testzip() is None, len(books)
+        (True, 2)
+
+    Queued books are sent over one connection, and those failed are tried
+    again later:
+
+        >>> from mailer import SmtpMailer
+        >>> from testserver import SmtpSink
+        >>> db.update('delivery', where='id=1', address='bad@example.com')
+        1
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> with SmtpSink(refused=['bad@example.com']) as sink:
+        ...     sent = mgr.deliver(SmtpMailer(port=sink.port), maxAttempts=2, backoff=0)
+        ...     resent = mgr.deliver(SmtpMailer(port=sink.port), maxAttempts=2, backoff=0)
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> sent, resent, len(sink.messages), sink.connections
+        ((8, 1, 0), (0, 0, 1), 8, 2)
+        >>> [(d.address, d.attempts, d.failed) for d in db.select('delivery')]
+        [(u'bad@example.com', 2, 1)]
+        >>> os.listdir('data/outbox')
+        []
+
+    Stages of the runs are timed into the run log:
+
+        >>> sorted(set((r.job, r.stage) for r in db.select('run_log')))
+        [(u'deliver', u'send'), (u'kindlegen', u'build'), (u'kindlegen', u'queue'), (u'update', u'fetch'), (u'update', u'parse'), (u'update', u'save'), (u'update', u'write')]
+        >>> [(r.status, r.errors) for r in db.query("SELECT status, count(error) errors FROM run_log WHERE job='deliver'")]
+        [(None, 2)]
+
+    Entries of books sent are read, those of books given up stay unread:
+
+        >>> db.update('account_entry', where='1=1', unread=1) > 0
+        True
+        >>> db.update('account', where='id=1', delivery_address='bad@example.com')
+        1
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> mgr.kindlegen(5, format='epub')
+        >>> with SmtpSink(refused=['bad@example.com']) as sink:
+        ...     delivered = mgr.deliver(SmtpMailer(port=sink.port), maxAttempts=1)
+        >>> sys.stdout = stdout
+        >>> delivered, [r.account_id for r in db.select('account_entry', what='DISTINCT account_id', where='unread=1')]
+        ((2, 0, 1), [1])
+        >>> db.update('account', where='id=1', delivery_address='kindle@example.com')
+        1
+        >>> db.update('account_entry', where='1=1', unread=0) > 0
+        True
+
+    Entries failing to be written are logged with their error:
+
+        >>> mgr._runLog = runlog.RunLog(db, 'update')
+        >>> mgr._updateEntries(1, [(u'http://example.com/empty', u'Empty', None, u'Mon', None, u'')]) # doctest: +ELLIPSIS
+        Error save entry `http://example.com/empty`, AttributeError: 'NoneType' object has no attribute 'encode'
+            0 new, 0 updated, 0 not rewritten, ...
+        (0, 0, 0)
+        >>> mgr._runLog.save(), [r.error for r in db.select('run_log', where="stage='write' AND error IS NOT NULL")]
+        (2, [u"AttributeError: 'NoneType' object has no attribute 'encode'"])
+        >>> mgr._runLog = None
+
+    Books are made of entries read from the database on each pass, the
+    same contents of other feeds once:
+
+        >>> mgr.subscribe(2, 1)
+        (2, 1)
+        >>> shared = (u'http://example.com/2', u'Shared', None, u'Mon', None, u'<p>Shared</p>')
+        >>> [mgr._updateEntries(feedId, [shared])[0] for feedId in (1, 2)] # doctest: +ELLIPSIS
+            1 new, ...
+        [1, 1]
+        >>> entries = _UnreadEntries.forAccount(db, mgr._store, mgr._UNREAD_SQLS['rows'], 1)
+        >>> len(entries), [e.entry_title for e in entries], [e.entry_title for e in entries]
+        (1, [u'Shared'], [u'Shared'])
+
+    Or by read marks of subscriptions, migrated from the rows:
+
+        >>> first = db.select('entry', what='min(id) id', where='feed_id=3')[0].id
+        >>> db.update('account_entry', where='account_id=3 AND entry_id IN $ids',
+        ...           vars={'ids': [first + 5, first + 9]}, unread=1)
+        2
+        >>> def unread(mgr):
+        ...     sql = mgr._UNREAD_SQLS[mgr._unread]
+        ...     return [(a.id, [e.entry_id for e in _UnreadEntries(db, mgr._store, sql, a.id, 0, sys.maxint)])
+        ...             for a in db.select('account')]
+        >>> rows = unread(mgr)
+        >>> rows[:2], rows[2] == (3, [first + 5, first + 9])
+        ([(1, [82]), (2, [82])], True)
+        >>> mgr.migrateUnread()
+        Traceback (most recent call last):
+        ...
+        ValueError: unread rows are migrated by the 'watermark' model, not `rows`
+        >>> marks = FeedManager(db, datapath='data', unread='watermark')
+        >>> marks.migrateUnread()
+        5 read marks, 23 read entries after marks, 80 rows deleted
+        (5, 23, 80)
+        >>> unread(marks) == rows
+        True
+        >>> db.select('account_entry', what='count(*) c')[0].c
+        0
+
+    New entries are unread by subscribers without writing a row for each:
+
+        >>> marks._updateEntries(1, [(u'http://example.com/3', u'New', None, u'Mon', None, u'<p>New</p>')]) # doctest: +ELLIPSIS
+            1 new, ...
+        (1, 0, 0)
+        >>> unread(marks)[:2], db.select('account_entry', what='count(*) c')[0].c
+        ([(1, [82, 84]), (2, [82, 84])], 0)
+        >>> marks._markRead(3, first + 9)
+        >>> unread(marks)[2], set(r.entry_id > first + 9 for r in db.select('account_entry_read', where='account_id=3'))
+        ((3, []), set([True]))
+
+    Entries fetched before retention days are deleted with their contents,
+    unless unread:
+
+        >>> last = db.select('entry', what='max(id) id', where='feed_id=3')[0].id
+        >>> db.delete('account_entry_read', where='account_id=3 AND entry_id=$last', vars=locals())
+        1
+        >>> digests = [e.content_hash for e in db.select('entry', where='feed_id=3')]
+        >>> links = [e.link for e in db.select('entry', where='feed_id=3', order='id')]
+        >>> db.update('entry', where='feed_id=3', fetched_at=int(time.time()) - 40 * 86400)
+        30
+        >>> sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        >>> deleted = marks.compact(readDays=30, unreadDays=90, pause=0)
+        >>> sys.stdout, log = stdout, sys.stdout.getvalue()
+        >>> deleted
+        (0, 29, 0)
+        >>> print log # doctest: +ELLIPSIS
+        0 read rows deleted
+            29 entries deleted
+        29 entries deleted
+        0 orphan files deleted
+        0 entries rewritten, 0 packs dropped
+        incremental vacuum disabled, compact with vacuum once
+        compacted in ...
+        >>> [e.id for e in db.select('entry', where='feed_id=3')] == [last]
+        True
+        >>> [digest in marks._store for digest in digests].count(True)
+        1
+
+    Deleted entries still listed by their feed are not saved again, until
+    the feed no longer lists them:
+
+        >>> old = (links[0], u'Old', None, u'Mon', None, u'<p>Old</p>')
+        >>> marks._updateEntries(3, [old, (links[-1],) + old[1:]], complete=True) # doctest: +ELLIPSIS
+            0 new, 1 updated, 0 not rewritten, ...
+        (0, 1, 0)
+        >>> db.select('entry_deleted', what='count(*) c', where='feed_id=3')[0].c
+        1
+        >>> marks._updateEntries(3, [(links[-1],) + old[1:]], complete=True) # doctest: +ELLIPSIS
+            0 new, 0 updated, 0 not rewritten, ...
+        (0, 0, 0)
+        >>> db.select('entry_deleted', what='count(*) c', where='feed_id=3')[0].c
+        0
     '''
 
     _INIT_SQLS = [
@@ -324,7 +990,16 @@ CREATE TABLE IF NOT EXISTS feed
  last_updated TEXT,
  http_last_modified TEXT,
  http_etag TEXT,
- actived INTEGER NOT NULL DEFAULT 1
+ actived INTEGER NOT NULL DEFAULT 1,
+ fetch_interval INTEGER,
+ next_fetch_at INTEGER,
+ last_changed_at INTEGER,
+ unchanged_count INTEGER NOT NULL DEFAULT 0,
+ retention_days INTEGER,
+ subscriber_count INTEGER NOT NULL DEFAULT 0,
+ failure_count INTEGER NOT NULL DEFAULT 0,
+ last_error TEXT,
+ last_error_at INTEGER
 )
 ''',
 '''
@@ -337,6 +1012,8 @@ CREATE TABLE IF NOT EXISTS entry
  title TEXT NOT NULL,
  author TEXT,
  pub_date TEXT,
+ content_hash TEXT,
+ fetched_at INTEGER,
  CONSTRAINT fk_feed_id FOREIGN KEY (feed_id) REFERENCES feed (id)
 )
 ''',
@@ -346,6 +1023,7 @@ CREATE TABLE IF NOT EXISTS account_feed
  id INTEGER PRIMARY KEY AUTOINCREMENT,
  account_id INTEGER NOT NULL,
  feed_id INTEGER NOT NULL,
+ read_until INTEGER NOT NULL DEFAULT 0,
  CONSTRAINT fk_af_account_id FOREIGN KEY (account_id) REFERENCES account (id),
  CONSTRAINT fk_af_feed_id FOREIGN KEY (feed_id) REFERENCES feed (id)
 )
@@ -364,53 +1042,222 @@ CREATE TABLE IF NOT EXISTS account_entry
 )
 ''',
 '''
+CREATE TABLE IF NOT EXISTS account_entry_read
+(
+ account_id INTEGER NOT NULL,
+ entry_id INTEGER NOT NULL,
+ CONSTRAINT pk_aer PRIMARY KEY (account_id, entry_id),
+ CONSTRAINT fk_aer_account_id FOREIGN KEY (account_id) REFERENCES account (id),
+ CONSTRAINT fk_aer_entry_id FOREIGN KEY (entry_id) REFERENCES entry (id)
+)
+''',
+'''
+CREATE TABLE IF NOT EXISTS entry_deleted
+(
+ feed_id INTEGER NOT NULL,
+ path TEXT NOT NULL,
+ CONSTRAINT pk_entry_deleted PRIMARY KEY (feed_id, path)
+)
+''',
+'''
+CREATE TABLE IF NOT EXISTS blob
+(
+ digest TEXT NOT NULL PRIMARY KEY
+)
+''',
+'''
+CREATE TABLE IF NOT EXISTS delivery
+(
+ id INTEGER PRIMARY KEY AUTOINCREMENT,
+ account_id INTEGER NOT NULL,
+ address TEXT NOT NULL,
+ path TEXT NOT NULL,
+ name TEXT NOT NULL,
+ attempts INTEGER NOT NULL DEFAULT 0,
+ next_attempt_at INTEGER NOT NULL,
+ failed INTEGER NOT NULL DEFAULT 0,
+ last_error TEXT,
+ max_id INTEGER,
+ CONSTRAINT fk_delivery_account_id FOREIGN KEY (account_id) REFERENCES account (id)
+)
+''',
+'''
+CREATE TABLE IF NOT EXISTS data_version
+(
+ name TEXT NOT NULL PRIMARY KEY,
+ version INTEGER NOT NULL
+)
+''',
+'''
 CREATE INDEX IF NOT EXISTS ix_account_actived ON account (actived)
 ''',
 '''
 CREATE INDEX IF NOT EXISTS ix_feed_actived ON feed (actived)
 ''',
 '''
+CREATE INDEX IF NOT EXISTS ix_feed_actived_next_fetch ON feed (actived, next_fetch_at)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_feed_actived_subscriber_count ON feed (actived, subscriber_count, id)
+''',
+'''
 CREATE UNIQUE INDEX IF NOT EXISTS ix_account_feed_pk ON account_feed (account_id, feed_id)
 ''',
 '''
 CREATE INDEX IF NOT EXISTS ix_entry_feed_path ON entry (feed_id, path)
 ''',
 '''
+CREATE INDEX IF NOT EXISTS ix_entry_content_hash ON entry (content_hash)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_entry_feed ON entry (feed_id)
+''',
+'''
 CREATE INDEX IF NOT EXISTS ix_account_actived_hour ON account (actived, delivery_actived, delivery_hour)
 ''',
 '''
 CREATE INDEX IF NOT EXISTS ix_account_entry_unread ON account_entry (account_id, unread)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_account_entry_entry ON account_entry (entry_id)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_delivery_due ON delivery (failed, next_attempt_at)
 '''
 ]
 
-    def __init__(self, db, datapath='.'):
+    # columns added after tables were created, as (table, column, definition)
+    _INIT_COLUMNS = [
+        ('entry', 'content_hash', 'TEXT'),
+        ('feed', 'fetch_interval', 'INTEGER'),
+        ('feed', 'next_fetch_at', 'INTEGER'),
+        ('feed', 'last_changed_at', 'INTEGER'),
+        ('feed', 'unchanged_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('account_feed', 'read_until', 'INTEGER NOT NULL DEFAULT 0'),
+        ('entry', 'fetched_at', 'INTEGER'),
+        ('feed', 'retention_days', 'INTEGER'),
+        ('feed', 'subscriber_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('feed', 'failure_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('feed', 'last_error', 'TEXT'),
+        ('feed', 'last_error_at', 'INTEGER'),
+        ('delivery', 'max_id', 'INTEGER'),
+        ]
+
+    # statements filling columns of _INIT_COLUMNS just added
+    _BACKFILL_SQLS = {
+        ('feed', 'subscriber_count'): '''
+UPDATE feed SET subscriber_count=(SELECT count(*) FROM account_feed WHERE account_feed.feed_id=feed.id)''',
+        # the fetch time of older entries is unknown, retain them from now on
+        ('entry', 'fetched_at'): '''
+UPDATE entry SET fetched_at=CAST(strftime('%s', 'now') AS INTEGER)''',
+        }
+
+    # ids of unread entries of $account_id up to $max_id, by unread model
+    _UNREAD_SQLS = {
+        # a row of each new entry for each subscriber
+        'rows': '''
+SELECT entry_id FROM account_entry
+WHERE account_id=$account_id AND unread=1 AND entry_id<=$max_id''',
+        # entries after the read mark of each subscription, except those read
+        'watermark': '''
+SELECT e.id FROM account_feed af, entry e
+WHERE af.account_id=$account_id AND e.feed_id=af.feed_id
+ AND e.id>af.read_until AND e.id<=$max_id
+ AND NOT EXISTS (SELECT 1 FROM account_entry_read r
+                 WHERE r.account_id=af.account_id AND r.entry_id=e.id)''',
+        }
+
+    # whether entry.id is unread by any account, by unread model
+    _UNREAD_BY_ANY_SQLS = {
+        'rows': '''
+EXISTS (SELECT 1 FROM account_entry ae WHERE ae.entry_id=entry.id AND ae.unread=1)''',
+        'watermark': '''
+EXISTS (SELECT 1 FROM account_feed af
+        WHERE af.feed_id=entry.feed_id AND af.read_until<entry.id
+         AND NOT EXISTS (SELECT 1 FROM account_entry_read r
+                         WHERE r.account_id=af.account_id AND r.entry_id=entry.id))''',
+        }
+
+    # recent entries checked to stop parsing stream feeds
+    _KNOWN_LINKS = 100
+    # max variables of a sqlite statement is 999
+    _BATCH_SIZE = 500
+
+    def __init__(self, db, datapath='.', scheduler=None, store=None, bundles=None,
+                 unread='rows', accounts=None):
         """
         Constructor
         Arguments:
         - `db`: web.database returned object
+        - `scheduler`: FeedScheduler deciding when feeds are fetched again
+        - `store`: store of entry contents, PackStore under `datapath` by default
+        - `bundles`: BundleCache of generated books, under `datapath` by default
+        - `unread`: 'rows' of account_entry for each subscriber, or 'watermark'
+          read mark of account_feed, see `migrateUnread`
+        - `accounts`: TtlCache of (id, actived) of account names
         """
+        if unread not in self._UNREAD_SQLS:
+            raise ValueError('unknown unread model `%s`' % (unread,))
+        self._unread = unread
         self._db = db
+        self._scheduler = scheduler or FeedScheduler()
         cursor = db.ctx.db.cursor()
         try:
-            for sql in self._INIT_SQLS:
+            tables = [sql for sql in self._INIT_SQLS if 'CREATE TABLE' in sql]
+            for sql in tables:
                 cursor.execute(sql)
+            # upgrade tables created by older versions
+            for table, column, definition in self._INIT_COLUMNS:
+                cursor.execute('PRAGMA table_info(%s)' % table)
+                if column not in [c[1] for c in cursor.fetchall()]:
+                    cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+                    if (table, column) in self._BACKFILL_SQLS:
+                        cursor.execute(self._BACKFILL_SQLS[(table, column)])
+            for sql in self._INIT_SQLS:
+                if sql not in tables:
+                    cursor.execute(sql)
         finally:
             cursor.close()
 
         self._datapath = datapath
+        self._store = store or PackStore(db, datapath)
+        self._bundles = bundles or BundleCache(os.path.join(datapath, 'bundles'))
+        self._accounts = accounts or TtlCache(maxSize=1000, ttl=300)
+        # RunLog of the running job
+        self._runLog = None
+        runlog.init(db)
 
 
     def account(self, name):
+        '''Return (id, actived) of account `name`, created if not found.'''
+        cached = self._accounts.get(name)
+        if cached:
+            return cached
         db = self._db
         found = list(db.where('account', what='id,actived', name=name))
         if found:
-            return (found[0].id, found[0].actived)
+            account = (found[0].id, found[0].actived)
         else:
             try:
-                return (db.insert('account', name=name), 1)
+                account = (db.insert('account', name=name), 1)
             except sqlite3.IntegrityError:
-                found = list(db.where('account', what='id,actived', name=name)[0])
-                return (found[0].id, found[0].actived)
+                found = list(db.where('account', what='id,actived', name=name))
+                account = (found[0].id, found[0].actived)
+        self._accounts.put(name, account)
+        return account
+
+
+    def updateAccount(self, account, **values):
+        '''Update columns of account id `account` to `values`.'''
+        self._db.update('account', where='id=$account', vars=locals(), **values)
+        if 'actived' in values or 'name' in values:
+            # cached by name, rarely changed
+            self._accounts.invalidate()
+
+
+    def accountCache(self):
+        '''Return cache of accounts by name, for its statistics.'''
+        return self._accounts
 
 
     def _acount_entries(self, account):
@@ -454,228 +1301,844 @@ CREATE INDEX IF NOT EXISTS ix_account_entry_unread ON account_entry (account_id,
                 feed = db.where('feed', what='id', url=feed)[0].id
 
         try:
-            db.insert('account_feed', feed_id=feed, account_id=account)
+            with db.transaction():
+                # entries saved before are not unread
+                db.query('INSERT INTO account_feed (feed_id, account_id, read_until)'
+                         ' SELECT $feed, $account, ifnull(max(id), 0) FROM entry',
+                         vars=locals())
+                db.query('UPDATE feed SET subscriber_count=subscriber_count+1 WHERE id=$feed',
+                         vars=locals())
+                self._bumpVersion()
         except sqlite3.IntegrityError:
             pass
         return (feed, account)
 
 
     def unsubscribe(self, feed, account):
-        self._db.delete('account_feed',
-                        where='feed_id=$feed and account_id=$account',
-                        vars = locals())
+        db = self._db
+        with db.transaction():
+            if db.delete('account_feed',
+                         where='feed_id=$feed and account_id=$account',
+                         vars = locals()):
+                db.query('UPDATE feed SET subscriber_count=subscriber_count-1 WHERE id=$feed',
+                         vars=locals())
+                self._bumpVersion()
 
 
-    def list(self, account=None, limit=None, offset=None):
-        query = '''
-SELECT feed.id, feed.url, feed.title, feed.description, count(account_feed.id) account_count
-FROM feed LEFT OUTER JOIN account_feed ON feed.id=account_feed.feed_id AND feed.actived=1
-GROUP BY feed.id, feed.url, feed.title, feed.description
-ORDER BY count(account_feed.id) DESC, feed.id DESC
-'''
-        if limit:
-            query = query + ' LIMIT $limit'
-        if offset:
-            query = query + ' OFFSET $offset'
-        if account:
-            query = 'SELECT a.id, a.url, a.title, a.description, a.account_count, b.id subscribed FROM (' \
-                + query \
-                + ') a LEFT OUTER JOIN account_feed b ON a.id=b.feed_id and b.account_id=$account'
-        return list(self._db.query(query,
-                                   vars=locals()))
+    def dataVersion(self):
+        '''
+        Return version of listed feeds and subscriptions, increased when
+        they are changed by any process.
+        '''
+        found = list(self._db.select('data_version', what='version',
+                                     where="name='feeds'"))
+        return found[0].version if found else 0
 
-    def listNew(self, account=None, limit=None, offset=None):
-        query = '''
-SELECT feed.id, feed.url, feed.title, feed.description, count(account_feed.id) account_count
-FROM feed LEFT OUTER JOIN account_feed ON feed.id=account_feed.feed_id AND feed.actived=1
-GROUP BY feed.id, feed.url, feed.title, feed.description
-ORDER BY feed.id DESC
-'''
-        if limit:
-            query = query + ' LIMIT $limit'
-        if offset:
-            query = query + ' OFFSET $offset'
-        if account:
-            query = 'SELECT a.id, a.url, a.title, a.description, a.account_count, b.id subscribed FROM (' \
-                + query \
-                + ') a LEFT OUTER JOIN account_feed b ON a.id=b.feed_id and b.account_id=$account'
-        return list(self._db.query(query,
-                                   vars=locals()))
+
+    def _bumpVersion(self):
+        self._db.query("INSERT OR IGNORE INTO data_version (name, version) VALUES ('feeds', 0)")
+        self._db.query("UPDATE data_version SET version=version+1 WHERE name='feeds'")
 
 
-    def listSubscribed(self, account, limit=None, offset=None):
-        return list(self._db.select(['feed', 'account_feed'],
-                                    what='feed.id, feed.url, feed.title, feed.description, account_feed.id subscribed',
-                                    where='feed.id=account_feed.feed_id AND feed.actived=1 AND account_feed.account_id=$account',
-                                    order='account_feed.id DESC',
-                                    limit=limit,
-                                    offset=offset,
-                                    vars=locals()))
+    def subscribedFeeds(self, account, feeds):
+        '''Return set of ids in `feeds` subscribed by `account`.'''
+        feeds = [int(f) for f in feeds]
+        if not feeds:
+            return set()
+        return set(r.feed_id for r in self._db.select('account_feed', what='feed_id',
+                                                      where='account_id=$account AND feed_id IN $feeds',
+                                                      vars=locals()))
 
-    def update(self):
+
+    # feeds listed with subscription of $account
+    _LIST_SQL = '''
+SELECT feed.id, feed.url, feed.title, feed.description, feed.subscriber_count account_count,
+ account_feed.id subscribed
+FROM feed LEFT OUTER JOIN account_feed
+ ON account_feed.feed_id=feed.id AND account_feed.account_id=$account
+WHERE feed.actived=1 '''
+
+    def _page(self, query, keys, account, limit, after, before):
+        """
+        Return feeds of `query` ordered by `keys` descending, after cursor
+        `after` or before cursor `before`, which are tuples of key values
+        of a listed feed. Keys are (column, result name) tuples.
+        """
+        params = dict(account=account, limit=limit)
+        cursor = after or before
+        op = '<' if after else '>'
+        direction = ' ASC' if before else ' DESC'
+        order = lambda names: ' ORDER BY ' + ', '.join(n + direction for n in names)
+        limited = lambda sql: sql + (' LIMIT $limit' if limit else '')
+        columns = [k[0] for k in keys]
+        if cursor:
+            params.update(('c%d' % i, v) for i, v in enumerate(cursor))
+        if cursor and len(keys) > 1:
+            # (k0, k1) after (c0, c1) as two ranges of the index,
+            # k0=c0 AND k1<c1 then k0<c0, instead of scanning all k0=c0
+            parts = [query + ' AND %s=$c0 AND %s%s$c1' % (columns[0], columns[1], op),
+                     query + ' AND %s%s$c0' % (columns[0], op)]
+            query = limited(' UNION ALL '.join('SELECT * FROM (%s)' % limited(part + order(columns))
+                                               for part in parts)
+                            + order(k[1] for k in keys))
+        else:
+            if cursor:
+                query += ' AND %s%s$c0' % (columns[0], op)
+            query = limited(query + order(columns))
+        feeds = list(self._db.query(query, vars=params))
+        if before:
+            feeds.reverse()
+        return feeds
+
+
+    def list(self, account=None, limit=None, after=None, before=None):
+        """
+        Return active feeds by subscriber count, most subscribed first.
+
+        Pages are cursors of (account_count, id) of the last feed of the
+        page before, as `after`, or of the first feed of the page after,
+        as `before`.
+        """
+        return self._page(self._LIST_SQL,
+                          (('feed.subscriber_count', 'account_count'), ('feed.id', 'id')),
+                          account, limit, after, before)
+
+
+    def listNew(self, account=None, limit=None, after=None, before=None):
+        """
+        Return active feeds, newest first, paged by cursors of (id,).
+        """
+        return self._page(self._LIST_SQL, (('feed.id', 'id'),),
+                          account, limit, after, before)
+
+
+    def listSubscribed(self, account, limit=None, after=None, before=None):
+        """
+        Return active feeds subscribed by `account`, latest first, paged
+        by cursors of (subscribed,).
+        """
+        return self._page(self._LIST_SQL + ' AND account_feed.id IS NOT NULL',
+                          (('account_feed.id', 'subscribed'),),
+                          account, limit, after, before)
+
+
+    def update(self, workers=4, hostLimit=2, deadline=None, streaming=False,
+               force=False):
+        """
+        Fetch active feeds due by their schedule, or all of them if `force`,
+        and save their new entries.
+
+        Feeds are fetched and parsed by `workers` threads, at most `hostLimit`
+        of them on the same host at a time. Feeds not fetched within
+        `deadline` seconds are left to the next run. Entries are saved by
+        the calling thread only, as the single database writer.
+        HTTP connections are kept alive and shared by the workers.
+        With `streaming`, items are parsed incrementally and parsing stops
+        at the first entry already saved.
+        """
         db = self._db
-        for feed in list(db.select(['feed'], where='actived=1')):
+        pool = WorkerPool(workers, keyLimit=hostLimit, deadline=deadline)
+        http = HttpClient()
+        log = self._runLog = runlog.RunLog(db, 'update')
+
+        def fetch(feed):
+            timeout = pool.remaining()
+            with log.timer('fetch', feedId=feed.id) as info:
+                fetched = FeedFactory.fetch(feed.url,
+                                            lastModified=feed.http_last_modified,
+                                            etag=feed.http_etag,
+                                            timeout=10 if timeout is None else min(10, timeout),
+                                            http=http, info=info)
+            if fetched and not streaming:
+                body, lastModified, etag = fetched
+                with log.timer('parse', feedId=feed.id):
+                    return (FeedFactory.parse(feed.url, body), lastModified, etag)
+            return fetched
+
+        def host(feed):
+            return urlparse(normalize_url(feed.url)).netloc or None
+
+        avoided = 0
+        updated = 0
+        fetched = failed = deactivated = 0
+        now = int(time.time())
+        if force:
+            feeds = list(db.select(['feed'], where='actived=1'))
+        else:
+            feeds = list(db.select(['feed'],
+                                   where='actived=1 AND (next_fetch_at IS NULL OR next_fetch_at<=$now)',
+                                   vars=locals()))
+        for feed, feedObj, error in pool.run(feeds, fetch, key=host):
             print '>>>', feed.url
-            try:
-                feedObj = FeedFactory.parseFeed(feed.url,
-                                                lastModified=feed.http_last_modified,
-                                                etag=feed.http_etag)
-            except:
-                print 'Error when fetching and parsing feed,', sys.exc_info()[0]
+            if not error:
+                fetched += 1
+            if not feedObj:
+                if isinstance(error, DeadlineExceeded):
+                    # left to the next run, not failed
+                    print 'Not fetched before the deadline'
+                elif error:
+                    failed += 1
+                    deactivated += self._fail(feed, error)
+                else:
+                    self._schedule(feed, False) # HTTP 304 not modified
                 continue
 
-            if not feedObj:
-                continue # feed not updated by HTTP 304 not modified
+            try:
+                if streaming:
+                    # stream feeds parse in the thread using them
+                    body, lastModified, etag = feedObj
+                    feedObj = (FeedFactory.parse(feed.url, body, streaming=True),
+                               lastModified, etag)
+                with log.timer('save', feedId=feed.id) as values:
+                    counts = self._updateFeed(feed, feedObj)
+                    if counts:
+                        values.update(entries=counts[0], updated=counts[1])
+                self._schedule(feed, bool(counts and (counts[0] or counts[1])))
+                if counts:
+                    avoided += counts[2]
+                    updated += 1
+            except Exception as e:
+                failed += 1
+                deactivated += self._fail(feed, e)
+
+        if updated or deactivated:
+            # titles and descriptions of listed feeds may have changed
+            self._bumpVersion()
+        self._runLog = None
+        log.save()
+        http.close()
+        print '%d of %d due feeds fetched' % (fetched, len(feeds))
+        print failed, 'feeds failed,', deactivated, 'deactivated'
+        print avoided, 'unchanged entries not rewritten'
+        print http.stats()
+
+
+    def _schedule(self, feed, changed):
+        '''Save when to fetch `feed` next, after it's found `changed` or not.'''
+        now = int(time.time())
+        if changed:
+            interval, nextFetchAt = self._scheduler.changed(now, feed.last_changed_at,
+                                                            feed.fetch_interval)
+            self._db.update('feed', where='id=$id', vars={'id': feed.id},
+                            fetch_interval=interval,
+                            next_fetch_at=nextFetchAt,
+                            last_changed_at=now,
+                            unchanged_count=0,
+                            failure_count=0)
+        else:
+            unchangedCount = feed.unchanged_count + 1
+            self._db.update('feed', where='id=$id', vars={'id': feed.id},
+                            next_fetch_at=self._scheduler.unchanged(now, feed.fetch_interval,
+                                                                    unchangedCount),
+                            unchanged_count=unchangedCount,
+                            failure_count=0)
 
-            feedObj, lastModified, etag = feedObj
 
-            if feed.last_updated and feed.last_updated == feedObj.lastUpdated():
-                continue # double check feed not updated
+    def _fail(self, feed, error):
+        '''
+        Save `error` of fetching, parsing or saving `feed`, and when to
+        try it again; deactivate it after failing too many times in a row.
+        Return whether it is deactivated.
+        '''
+        now = int(time.time())
+        failureCount = feed.failure_count + 1
+        message = '%s: %s' % (error.__class__.__name__, error)
+        print 'Error when fetching and parsing feed, %s' % (message,)
+        nextFetchAt = self._scheduler.failed(now, feed.fetch_interval, failureCount)
+        values = dict(failure_count=failureCount, last_error=message[:1000],
+                      last_error_at=now)
+        if nextFetchAt is None:
+            print 'Deactivated feed#%d after %d failures' % (feed.id, failureCount)
+            values['actived'] = 0
+        else:
+            values['next_fetch_at'] = nextFetchAt
+        self._db.update('feed', where='id=$id', vars={'id': feed.id}, **values)
+        return nextFetchAt is None
 
-            for entry in reversed(list(feedObj.items())):
-                try:
-                    self._update(feed.id, entry)
-                except:
-                    print 'Error save entry `%s`,' % (entry[0],), sys.exc_info()[0]
 
-            db.update('feed', where='id=$id', vars={'id':feed.id},
-                      last_updated=feedObj.lastUpdated(),
-                      title=feedObj.title(),
-                      description=feedObj.description(),
-                      http_last_modified=lastModified,
-                      http_etag=etag)
+    def reactivate(self, feed):
+        '''Activate `feed` given up after failures, to be fetched on next update.'''
+        count = self._db.update('feed', where='id=$feed', vars=locals(),
+                                actived=1, failure_count=0, next_fetch_at=None)
+        if count:
+            self._bumpVersion()
+        return count
 
 
-    def _update(self, feedId, entryObj):
+    def failureReport(self, days=7, top=20):
+        '''
+        Return the `top` feeds spending most time in failed fetches in
+        the last `days`, by the run log, with their failure counters.
+        '''
+        since = int(time.time()) - days * 86400
+        return list(self._db.query('''
+SELECT feed.id, feed.url, feed.actived, feed.failure_count, feed.last_error, feed.last_error_at,
+ sum(run_log.seconds) seconds, count(*) failures
+FROM run_log, feed
+WHERE run_log.run_at>=$since AND run_log.job='update' AND run_log.error IS NOT NULL
+ AND feed.id=run_log.feed_id
+GROUP BY feed.id, feed.url, feed.actived, feed.failure_count, feed.last_error, feed.last_error_at
+ORDER BY sum(run_log.seconds) DESC, feed.id
+LIMIT $top''', vars=locals()))
+
+
+    def _updateFeed(self, feed, feedObj):
         db = self._db
-        url, title, author, pubdate, summary, content = entryObj
+        feedObj, lastModified, etag = feedObj
+
+        if feed.last_updated and feed.last_updated == feedObj.lastUpdated():
+            return # double check feed not updated
+
+        known = ()
+        if feedObj.streaming:
+            known = set(e.link for e in db.select('entry', what='link',
+                                                  where='feed_id=$id', order='id DESC',
+                                                  limit=self._KNOWN_LINKS,
+                                                  vars={'id': feed.id}))
+
+        return self._updateEntries(feed.id, reversed(list(feedObj.items(known=known))),
+                                   complete=not feedObj.streaming,
+                                   last_updated=feedObj.lastUpdated(),
+                                   title=feedObj.title(),
+                                   description=feedObj.description(),
+                                   http_last_modified=lastModified,
+                                   http_etag=etag)
+
+
+    def _entryPath(self, feedId, url):
         hashval = hashlib.sha1(str(feedId)+':'+url.encode('utf-8')).hexdigest()
-        path = os.path.join(str(feedId), hashval[:2])
-        if not os.path.exists(os.path.join(self._datapath, path)):
-            os.makedirs(os.path.join(self._datapath, path), 0755)
-        path = os.path.join(path, hashval[2:]+'.html')
+        return os.path.join(str(feedId), hashval[:2], hashval[2:]+'.html')
+
+
+    def _contentHash(self, title, content):
+        '''Return digest of entry title and content with whitespaces normalized.'''
+        text = u' '.join((title or u'').split()) + u'\n' + u' '.join((content or u'').split())
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
-        entry = list(db.select(['entry'],
-                               where='feed_id=$feedId and path=$path',
-                               vars=locals()))
 
-        # already existed, and not updated
-        if entry and entry[0].pub_date == pubdate:
+    def _executemany(self, query, rows):
+        """
+        Execute `query` for each of `rows` in one call,
+        counted as one query of web.py.
+        """
+        if not rows:
             return
+        db = self._db
+        cursor = db.ctx.db.cursor()
+        try:
+            cursor.executemany(query, rows)
+        finally:
+            cursor.close()
+        db.ctx.dbq_count += 1
 
-        with db.transaction() as tx:
+
+    def _updateEntries(self, feedId, entries, complete=False, **feedValues):
+        """
+        Save entries of a feed, and update the feed row with `feedValues`,
+        in one transaction.
+
+        Existing entries are looked up at once, new entries and their
+        account_entry rows are inserted in batch. Entries of unchanged
+        content hash are not written again, only their date, title and
+        author if changed. Entry contents are kept in
+        the store by content hash, once for all feeds having them, and
+        removed when no entry refers to them.
+
+        Entries deleted by `compact` are not saved again while the feed
+        still lists them; if `entries` are all entries of the feed,
+        `complete`, those no longer listed are forgotten.
+
+        Return tuple of new, updated and not rewritten entry counts.
+        """
+        db = self._db
+        start = time.time()
+        queries = db.ctx.dbq_count
+
+        # later entries win, as they were saved one by one
+        found = {}
+        paths = []
+        for entry in entries:
+            path = self._entryPath(feedId, entry[0])
+            if path not in found:
+                paths.append(path)
+            found[path] = entry
+
+        existing = {}
+        deleted = set()
+        for chunk in self._chunks(paths):
+            for e in db.select('entry', what='id, path, title, author, pub_date, content_hash',
+                               where='feed_id=$feedId AND path IN $chunk',
+                               vars=locals()):
+                existing[e.path] = e
+            deleted.update(e.path for e in db.select('entry_deleted', what='path',
+                                                     where='feed_id=$feedId AND path IN $chunk',
+                                                     vars=locals()))
+        forgotten = []
+        if complete:
+            listed = set(paths)
+            forgotten = [e.path for e in db.select('entry_deleted', what='path',
+                                                   where='feed_id=$feedId', vars=locals())
+                         if e.path not in listed]
+
+        changed = []
+        hashes = []
+        metas = []
+        avoided = 0
+        for path in paths:
+            if path in deleted:
+                continue
+            url, title, author, pubdate, summary, content = found[path]
+            contentHash = self._contentHash(title, content if content else summary)
+            entry = existing.get(path)
             if entry:
-                db.update('entry', where='id=$id', vars={'id':entry[0].id},
-                                title=title, author=author, pub_date=pubdate)
-            else:
-                entryId = db.insert('entry',
-                                    feed_id=feedId,
-                                    path=path,
-                                    link=url,
-                                    title=title,
-                                    author=author,
-                                    pub_date=pubdate)
-                miValues = list(db.select('account_feed', what='account_id, feed_id, $entryId entry_id',
-                                          where='feed_id=$feedId', vars=locals()))
-                db.multiple_insert('account_entry', miValues)
-            self._writefile(url, path, title, content if content else summary)
-
-
-    def _writefile(self, url, path, title, content):
-        path = os.path.join(self._datapath, path)
+                if entry.content_hash == contentHash:
+                    if (entry.title, entry.author, entry.pub_date) != (title, author, pubdate):
+                        # the stored content is the same
+                        metas.append((title, author, pubdate, entry.id))
+                        avoided += 1
+                    continue
+                if entry.content_hash is None and entry.pub_date == pubdate:
+                    # saved without hash, and not updated
+                    hashes.append((contentHash, entry.id))
+                    continue
+            changed.append((path, contentHash))
 
+        stored = set()
+        writeSeconds = 0.0
+        for chunk in self._chunks(list(set(h for p, h in changed))):
+            stored.update(b.digest for b in db.select('blob', what='digest',
+                                                      where='digest IN $chunk',
+                                                      vars=locals()))
+
+        # contents are stored in the same transaction as their index rows
+        with db.transaction() as tx:
+            inserts = []
+            updates = []
+            blobs = []
+            for path, contentHash in changed:
+                url, title, author, pubdate, summary, content = found[path]
+                if contentHash not in stored:
+                    writeStart = time.time()
+                    try:
+                        self._writefile(url, contentHash, title, content if content else summary)
+                    except Exception as e:
+                        message = '%s: %s' % (e.__class__.__name__, e)
+                        print 'Error save entry `%s`, %s' % (url, message)
+                        if self._runLog:
+                            self._runLog.record('write', time.time() - writeStart,
+                                                feedId=feedId, error=message)
+                        continue
+                    finally:
+                        writeSeconds += time.time() - writeStart
+                    stored.add(contentHash)
+                    blobs.append((contentHash,))
+
+                entry = existing.get(path)
+                if entry:
+                    updates.append((title, author, pubdate, contentHash, entry.id))
+                else:
+                    inserts.append((feedId, path, url, title, author, pubdate, contentHash, int(start)))
+
+            updated = set(u[-1] for u in updates)
+            dereferenced = [e.content_hash for e in existing.values()
+                            if e.id in updated and e.content_hash]
+            self._executemany('INSERT OR IGNORE INTO blob (digest) VALUES (?)', blobs)
+            if inserts:
+                lastId = db.query('SELECT max(id) id FROM entry WHERE feed_id=$feedId',
+                                  vars=locals())[0].id or 0
+                self._executemany('INSERT INTO entry (feed_id, path, link, title, author, pub_date, content_hash, fetched_at)'
+                                  ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', inserts)
+            if inserts and self._unread == 'rows':
+                db.query('''
+INSERT INTO account_entry (account_id, feed_id, entry_id)
+SELECT account_feed.account_id, account_feed.feed_id, entry.id
+FROM account_feed, entry
+WHERE account_feed.feed_id=$feedId AND entry.feed_id=$feedId AND entry.id>$lastId
+''', vars=locals())
+            self._executemany('UPDATE entry SET title=?, author=?, pub_date=?, content_hash=? WHERE id=?',
+                              updates)
+            self._executemany('UPDATE entry SET content_hash=? WHERE id=?', hashes)
+            self._executemany('UPDATE entry SET title=?, author=?, pub_date=? WHERE id=?', metas)
+            for chunk in self._chunks(forgotten):
+                db.delete('entry_deleted', where='feed_id=$feedId AND path IN $chunk',
+                          vars=locals())
+            if feedValues:
+                db.update('feed', where='id=$feedId', vars=locals(), **feedValues)
+            orphans = self._orphanBlobs(dereferenced)
+
+        for digest in orphans:
+            self._store.remove(digest)
+        if self._runLog:
+            self._runLog.record('write', writeSeconds, feedId=feedId, entries=len(blobs))
+
+        print '    %d new, %d updated, %d not rewritten, %d queries, %.3fs' % \
+            (len(inserts), len(updates), avoided, db.ctx.dbq_count - queries, time.time() - start)
+        return (len(inserts), len(updates), avoided)
+
+
+    def _chunks(self, values):
+        for i in range(0, len(values), self._BATCH_SIZE):
+            yield values[i:i+self._BATCH_SIZE]
+
+
+    def _orphanBlobs(self, digests):
+        '''
+        Delete rows of `digests` no entry refers to, return the deleted digests.
+        '''
+        db = self._db
+        orphans = []
+        for chunk in self._chunks(list(set(digests))):
+            orphans.extend(b.digest for b in db.query('''
+SELECT digest FROM blob
+WHERE digest IN $chunk
+ AND NOT EXISTS (SELECT 1 FROM entry WHERE entry.content_hash=blob.digest)
+''', vars=locals()))
+        for chunk in self._chunks(orphans):
+            db.delete('blob', where='digest IN $chunk', vars=locals())
+        return orphans
+
+
+    def _writefile(self, url, digest, title, content):
         parser = etree.HTMLParser(encoding='utf-8')
         html = etree.parse(StringIO(content.encode('utf-8')), parser)
-        # Remove empty links and images
-        for n in itertools.chain(html.xpath('//img'), \
-                                     html.xpath('//script'), \
-                                     html.xpath('//style')):
-            n.getparent().remove(n)
-        for a in html.xpath('//a'):
-            if not a.text:
-                a.getparent().remove(a)
-            # else:
-            #   a.tag='span'
-            #   a.attrib.clear()
-
-        cont_nodes = html.xpath('/html/body')[0].getchildren()
+        # Remove images, scripts, empty links etc.
+        body = html.getroot().find('body')
+        sanitizer.clean(body)
+
+        cont_nodes = body.getchildren()
         html = htmlNode()
         body = etree.SubElement(html, 'body')
         etree.SubElement(body,'h2').text = title
         body.extend(cont_nodes)
-        with open(path, 'w') as fo:
-            fo.write(etree.tostring(html,
-                                    pretty_print=True,
-                                    encoding='utf-8',
-                                    xml_declaration=False))
+        self._store.put(digest, etree.tostring(html,
+                                               pretty_print=True,
+                                               encoding='utf-8',
+                                               xml_declaration=False))
 
 
-    def kindlegen(self, hour):
-        """
-        Call kindlegen to generate .mobi for accounts whose delivery_hour equals `hour`.
+    def compact(self, readDays=30, unreadDays=90, batch=500, pause=0.1,
+                vacuumPages=1000, vacuum=False):
         """
-        with cd(self._datapath) as notused:
-            date = datetime.datetime.strftime(datetime.datetime.now(),'%Y-%m-%d')
-            title = 'Feed2Mobi '
-            kindlegen = KindleGen()
+        Delete entries fetched before retention days, their read marks and
+        contents, and files of no entry; then reclaim space of the store and
+        of the database. Deleted entries are remembered, not to be saved
+        again as new while their feed lists them.
 
-            db = self._db
-            accounts = list(db.select(['account'],
-                                      what='id,delivery_address,delivery_bundle',
-                                      where='actived=1 AND delivery_actived=1 AND delivery_hour=$hour',
-                                      vars=locals()))
+        Entries are deleted `batch` at a time, each batch in its own short
+        transaction followed by `pause` seconds, not to block web requests.
 
-            for account in accounts:
-                address = account.delivery_address
-                bundle = account.delivery_bundle
+        Arguments:
+        - `readDays`: days to keep entries read by all subscribers, or
+          retention_days of their feed
+        - `unreadDays`: days to keep entries unread by any subscriber
+        - `vacuumPages`: free pages returned to the filesystem
+        - `vacuum`: rebuild the database once, to enable incremental vacuum
 
+        Return tuple of deleted rows, entries and files counts.
+        """
+        db = self._db
+        start = time.time()
+
+        rows = 0
+        if self._unread == 'rows':
+            while True:
                 with db.transaction() as tx:
-                    entries = list(db.select(['account_entry', 'entry', 'feed'],
-                                             what='''
-account_entry.feed_id,
-feed.title feed_title,
-account_entry.entry_id,
-entry.title entry_title,
-entry.author,
-entry.path''',
-                                             where='''
-account_entry.account_id=$account_id
- AND account_entry.unread=1
- AND account_entry.entry_id=entry.id
- AND account_entry.feed_id=feed.id''',
-                                             order='account_entry.feed_id ASC, account_entry.entry_id ASC',
-                                             vars={'account_id':account.id}))
-
-                    if entries and (bundle == 0 or len(entries) >= bundle):
-                        mobi = None
-                        try:
-                            mobi = kindlegen.execute(title, date, entries)
-                            if os.path.exists(mobi):
-                                mailfile = 'delivery.mail'
-                                with open(mailfile,'w') as fo:
-                                    fo.write(os.linesep.join(['From: feed2mobi@skypiea.info',
-                                                              'To: ' + address,
-                                                              'Subject: feed2mobi daily delivery']))
-                                p = Popen(['mutt', '-x', '-H', mailfile, '-a', mobi],
-                                              stdin=PIPE)
-                                p.communicate()
-                                if (0 == p.returncode):
-                                    print mobi, 'created successfully'
-                                else:
-                                    raise 'mutt return `%s` for `%s`' % (p.returncode, address)
-                            else:
-                                raise '.mobi file not generated for `%s`' % (address,)
-                        except:
-                            print "Unexpected error:", sys.exc_info()[0]
-                        else:
-                            for entry in entries:
-                                db.update('account_entry',
-                                          where='account_id=$account_id AND entry_id=$entry_id',
-                                          vars={'account_id': account.id, 'entry_id': entry.entry_id},
-                                          unread=0)
-                        finally:
-                            if os.path.exists(mobi):
-                                os.remove(mobi) # should do backup?
+                    deleted = db.query('''
+DELETE FROM account_entry WHERE rowid IN
+ (SELECT rowid FROM account_entry WHERE unread=0 LIMIT $batch)''', vars=locals())
+                rows += deleted
+                if deleted < batch:
+                    break
+                print '    %d read rows deleted' % (rows,)
+                time.sleep(pause)
+        print '%d read rows deleted' % (rows,)
+
+        now = int(time.time())
+        entries = files = 0
+        lastId = 0
+        while True:
+            expired = list(db.query('''
+SELECT entry.id, entry.feed_id, entry.path, entry.content_hash FROM entry, feed
+WHERE entry.id>$lastId AND feed.id=entry.feed_id
+ AND entry.fetched_at<$now-86400*ifnull(feed.retention_days, $readDays)
+ AND (entry.fetched_at<$now-86400*$unreadDays OR NOT %s)
+ORDER BY entry.id LIMIT $batch''' % (self._UNREAD_BY_ANY_SQLS[self._unread],), vars=locals()))
+            if not expired:
+                break
+            lastId = expired[-1].id
+            ids = [e.id for e in expired]
+            with db.transaction() as tx:
+                db.delete('account_entry', where='entry_id IN $ids', vars=locals())
+                db.delete('account_entry_read', where='entry_id IN $ids', vars=locals())
+                db.delete('entry', where='id IN $ids', vars=locals())
+                self._executemany('INSERT OR IGNORE INTO entry_deleted (feed_id, path) VALUES (?, ?)',
+                                  [(e.feed_id, e.path) for e in expired])
+                orphans = self._orphanBlobs([e.content_hash for e in expired if e.content_hash])
+            for digest in orphans:
+                self._store.remove(digest)
+            for e in expired:
+                # entries saved before the store have their own files
+                path = os.path.join(self._datapath, e.path)
+                if os.path.exists(path):
+                    os.remove(path)
+                    files += 1
+            entries += len(expired)
+            print '    %d entries deleted' % (entries,)
+            time.sleep(pause)
+        print '%d entries deleted' % (entries,)
+
+        orphans = self._orphanFiles()
+        files += orphans
+        print '%d orphan files deleted' % (orphans,)
+        print '%d entries rewritten, %d packs dropped' % self._store.compact()
+
+        cursor = db.ctx.db.cursor()
+        try:
+            if vacuum:
+                cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                cursor.execute('VACUUM')
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] == 2:
+                cursor.execute('PRAGMA incremental_vacuum(%d)' % (vacuumPages,))
+                cursor.fetchall()
+            else:
+                print 'incremental vacuum disabled, compact with vacuum once'
+            cursor.execute('PRAGMA optimize')
+        finally:
+            cursor.close()
+        print 'compacted in %.3fs' % (time.time() - start,)
+        return (rows, entries, files)
+
+
+    def _orphanFiles(self):
+        '''
+        Delete entry files under feed directories of datapath no entry
+        refers to, return count of deleted files.
+        '''
+        db = self._db
+        deleted = 0
+        for name in os.listdir(self._datapath):
+            if not name.isdigit() or not os.path.isdir(os.path.join(self._datapath, name)):
+                continue
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self._datapath, name)):
+                paths = [os.path.relpath(os.path.join(dirpath, f), self._datapath) for f in filenames]
+                for chunk in self._chunks(paths):
+                    known = set(e.path for e in db.select('entry', what='path',
+                                                          where='path IN $chunk', vars=locals()))
+                    for path in chunk:
+                        if path not in known:
+                            os.remove(os.path.join(self._datapath, path))
+                            deleted += 1
+        return deleted
+
+
+    def kindlegen(self, hour, workers=1, program='kindlegen', format='mobi'):
+        """
+        Call kindlegen to generate .mobi for accounts whose delivery_hour equals `hour`,
+        and queue them for `deliver`.
+
+        Books are built once for accounts having the same unread entries,
+        and kept in the bundle cache. Each book is built in its own
+        temporary directory, by `workers` threads; books are queued in
+        this thread. Entries are marked read by `deliver` once their book
+        is sent, until then they are in the next books too.
+
+        Arguments:
+        - `workers`: number of books built at once
+        - `program`: kindlegen program
+        - `format`: 'mobi' made by `program`, or 'epub' written in this process
+        """
+        date = datetime.datetime.strftime(datetime.datetime.now(),'%Y-%m-%d')
+        title = 'Feed2Mobi '
+        kindlegen = KindleGen(program, format=format)
+        ext = '.' + format
+        log = runlog.RunLog(self._db, 'kindlegen')
+
+        db = self._db
+        accounts = list(db.select(['account'],
+                                  what='id,delivery_address,delivery_bundle',
+                                  where='actived=1 AND delivery_actived=1 AND delivery_hour=$hour',
+                                  vars=locals()))
+
+        jobs = []
+        bundles = {}
+        for account in accounts:
+            bundle = account.delivery_bundle
+            unreadSql = self._UNREAD_SQLS[self._unread]
+            entries = _UnreadEntries.forAccount(db, self._store, unreadSql, account.id)
+            if len(entries) and (bundle == 0 or len(entries) >= bundle):
+                key = self._bundles.key(title, date, ((e.entry_id, e.content_hash) for e in entries))
+                if key not in bundles:
+                    bundles[key] = entries
+                jobs.append((account, key, entries))
+
+        def build(key):
+            mobi = self._bundles.get(key, ext)
+            if mobi:
+                return (mobi, False)
+            workdir = tempfile.mkdtemp(prefix='kindlegen-', dir=self._datapath)
+            articles = bundles[key]
+            try:
+                with log.timer('build', entries=len(articles)) as values:
+                    for article in articles:
+                        if not article.digest:
+                            # entries saved before the store have their own files
+                            target = os.path.join(workdir, article.path)
+                            if not os.path.exists(os.path.dirname(target)):
+                                os.makedirs(os.path.dirname(target))
+                            shutil.copyfile(os.path.join(self._datapath, article.path), target)
+                    mobi = kindlegen.execute(title, date, articles,
+                                             store=self._store, workdir=workdir)
+                    if not os.path.exists(os.path.join(workdir, mobi)):
+                        raise Exception('%s file not generated' % (ext,))
+                    values['bytes'] = os.path.getsize(os.path.join(workdir, mobi))
+                return (self._bundles.put(key, os.path.join(workdir, mobi)), True)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        start = time.time()
+        pool = WorkerPool(workers=workers)
+        books = {}
+        built = 0
+        for key, result, error in pool.run(bundles.keys(), build):
+            if error:
+                print 'Error build %s of %d entries,' % (ext, len(bundles[key])), error
+                continue
+            books[key], isNew = result
+            built += isNew
+
+        outbox = os.path.join(self._datapath, 'outbox')
+        if not os.path.exists(outbox):
+            os.makedirs(outbox)
+        # attach the book by its own name, not the cache key
+        name = title.replace(' ', '_')+'_'+date+ext
+        queued = 0
+        for account, key, entries in jobs:
+            if key not in books:
+                continue
+            with log.timer('queue', accountId=account.id, entries=len(entries)):
+                # the cached book may be evicted before it is sent
+                fd, path = tempfile.mkstemp(suffix=ext, dir=outbox)
+                os.close(fd)
+                shutil.copyfile(books[key], path)
+                db.insert('delivery', account_id=account.id,
+                          address=account.delivery_address,
+                          path=os.path.relpath(path, self._datapath),
+                          name=name, next_attempt_at=int(time.time()),
+                          max_id=entries.maxId)
+            queued += 1
+            print '%s: %d entries queued' % (account.delivery_address, len(entries))
+        evicted = self._bundles.evict()
+        log.save()
+        print '%d accounts, %d books, %d built, %d queued, %d evicted, %.3fs' % \
+            (len(jobs), len(bundles), built, queued, evicted, time.time() - start)
+
+
+    def _markRead(self, accountId, maxId):
+        '''
+        Mark unread entries of account `accountId` up to entry `maxId` read,
+        entries saved since were not in the book.
+        '''
+        db = self._db
+        if self._unread == 'rows':
+            db.update('account_entry',
+                      where='account_id=$accountId AND unread=1 AND entry_id<=$maxId',
+                      vars=locals(), unread=0)
+        else:
+            # entry ids grow, so all entries up to maxId are read
+            db.update('account_feed', where='account_id=$accountId AND read_until<$maxId',
+                      vars=locals(), read_until=maxId)
+            db.delete('account_entry_read', where='account_id=$accountId AND entry_id<=$maxId',
+                      vars=locals())
+
+
+    def migrateUnread(self):
+        """
+        Convert account_entry rows into read marks of account_feed, and
+        read entries after the marks into account_entry_read, then delete
+        the rows. Run once by a manager of the 'watermark' unread model,
+        before using that model only; raise ValueError for other models,
+        which still read the rows.
+
+        Return tuple of marks, exceptions and deleted row counts.
+        """
+        if self._unread != 'watermark':
+            raise ValueError("unread rows are migrated by the 'watermark' model, not `%s`"
+                             % (self._unread,))
+        db = self._db
+        with db.transaction() as tx:
+            # read up to the first unread entry, or all saved entries
+            marks = db.query('''
+UPDATE account_feed SET read_until=ifnull(
+ (SELECT min(entry_id) - 1 FROM account_entry ae
+  WHERE ae.account_id=account_feed.account_id AND ae.feed_id=account_feed.feed_id AND ae.unread=1),
+ (SELECT ifnull(max(id), 0) FROM entry))
+''')
+            exceptions = db.query('''
+INSERT OR IGNORE INTO account_entry_read (account_id, entry_id)
+SELECT af.account_id, e.id FROM account_feed af, entry e
+WHERE e.feed_id=af.feed_id AND e.id>af.read_until
+ AND NOT EXISTS (SELECT 1 FROM account_entry ae
+                 WHERE ae.account_id=af.account_id AND ae.entry_id=e.id AND ae.unread=1)
+''')
+            rows = db.delete('account_entry', where='1=1')
+        print '%d read marks, %d read entries after marks, %d rows deleted' % (marks, exceptions, rows)
+        return (marks, exceptions, rows)
+
+
+    def deliver(self, mailer, batch=50, maxAttempts=5, backoff=300):
+        """
+        Send queued books due by now through `mailer`, `batch` books per
+        connection, and mark their entries read. A failed book is tried
+        again after `backoff` seconds, doubled on each attempt, and given up
+        after `maxAttempts` attempts, leaving its entries unread.
+
+        Return tuple of sent, retried and given up counts.
+        """
+        db = self._db
+        now = int(time.time())
+        log = runlog.RunLog(db, 'deliver')
+        sent = retried = failed = 0
+        lastId = 0
+        while True:
+            deliveries = list(db.select('delivery',
+                                        where='failed=0 AND next_attempt_at<=$now AND id>$lastId',
+                                        order='id', limit=batch, vars=locals()))
+            if not deliveries:
+                break
+            lastId = deliveries[-1].id
+            with mailer:
+                for d in deliveries:
+                    path = os.path.join(self._datapath, d.path)
+                    try:
+                        with log.timer('send', accountId=d.account_id,
+                                       bytes=os.path.getsize(path)):
+                            mailer.send(d.address, 'feed2mobi daily delivery', path, d.name)
+                    except Exception as e:
+                        attempts = d.attempts + 1
+                        error = '%s: %s' % (e.__class__.__name__, e)
+                        print 'Error mail %s to `%s`,' % (d.name, d.address), error
+                        if attempts < maxAttempts:
+                            db.update('delivery', where='id=$id', vars=d,
+                                      attempts=attempts, last_error=error,
+                                      next_attempt_at=now + backoff * 2 ** (attempts - 1))
+                            retried += 1
+                            continue
+                        db.update('delivery', where='id=$id', vars=d,
+                                  attempts=attempts, last_error=error, failed=1)
+                        failed += 1
+                    else:
+                        with db.transaction() as tx:
+                            db.delete('delivery', where='id=$id', vars=d)
+                            # books queued by older versions were marked read
+                            if d.max_id is not None:
+                                self._markRead(d.account_id, d.max_id)
+                        sent += 1
+                    if os.path.exists(path):
+                        os.remove(path)
+        log.save()
+        print '%d sent, %d retried, %d given up' % (sent, retried, failed)
+        return (sent, retried, failed)
 
 
 
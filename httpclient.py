@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+'''
+HTTP client keeping connections alive per host and decoding gzip/deflate
+responses, shared by the threads fetching feeds.
+
+    >>> import os.path
+    >>> from testserver import SampleServer
+    >>> http = HttpClient()
+    >>> with SampleServer(gzip=True) as server:
+    ...     resps = [http.get(server.url(name))
+    ...              for name in ('ifanr.rss2.xml', 'ongoing.atom.xml')]
+    ...     again = http.get(server.url('ifanr.rss2.xml'),
+    ...                      {'If-None-Match': resps[0].headers.get('etag')})
+    ...     http.close() # ends the keep-alive connection served by the server
+    >>> [r.code for r in resps], again.code
+    ([200, 200], 304)
+    >>> len(resps[0].read()) == os.path.getsize('samples/ifanr.rss2.xml')
+    True
+    >>> http.requests, http.connections, http.reused
+    (3, 1, 2)
+    >>> http.bytesReceived < http.bytesDecoded
+    True
+'''
+
+import gzip
+import httplib
+import socket
+import threading
+import zlib
+
+from StringIO import StringIO
+from urlparse import urljoin, urlsplit
+
+
+class Response(object):
+    '''Response of HttpClient, whose body is read and decoded.'''
+
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self._body = body
+
+    def read(self):
+        return self._body
+
+
+def decode(body, encoding):
+    '''Return `body` decoded of content-encoding `encoding`.'''
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=StringIO(body)).read()
+    elif encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # raw deflate stream without zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class HttpClient(object):
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, maxIdle=4, userAgent='feed2mobi'):
+        """
+        Constructor
+        Arguments:
+        - `maxIdle`: max idle connections kept per host
+        - `userAgent`: value of User-Agent header
+        """
+        self._maxIdle = maxIdle
+        self._userAgent = userAgent
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.bytesReceived = 0
+        self.bytesDecoded = 0
+
+
+    def _count(self, **counts):
+        self._lock.acquire()
+        try:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+        finally:
+            self._lock.release()
+
+
+    def _connection(self, scheme, netloc, timeout):
+        '''Return tuple of connection to `netloc`, and if it is reused.'''
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((scheme, netloc))
+            conn = idle.pop() if idle else None
+        finally:
+            self._lock.release()
+        if conn:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=timeout)
+        self._count(connections=1)
+        return (conn, False)
+
+
+    def _release(self, scheme, netloc, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self._maxIdle:
+                idle.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+        if conn:
+            conn.close()
+
+
+    def _request(self, url, headers, timeout):
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if query:
+            path = path + '?' + query
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers['User-Agent'] = self._userAgent
+
+        while True:
+            conn, reused = self._connection(scheme, netloc, timeout)
+            try:
+                conn.request('GET', path or '/', headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # server closed idle connection, retry on new one
+                    continue
+                raise
+            break
+
+        self._count(requests=1, reused=int(reused), bytesReceived=len(body))
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(scheme, netloc, conn)
+
+        respHeaders = dict(resp.getheaders())
+        body = decode(body, respHeaders.get('content-encoding'))
+        self._count(bytesDecoded=len(body))
+        return Response(url, resp.status, respHeaders, body)
+
+
+    def get(self, url, headers={}, timeout=10, redirects=5):
+        '''
+        Return Response of GET `url` with `headers`, following redirects.
+        '''
+        for i in range(redirects + 1):
+            resp = self._request(url, headers, timeout)
+            if resp.code not in self.REDIRECTS or not resp.headers.get('location'):
+                return resp
+            url = urljoin(url, resp.headers['location'])
+        raise httplib.HTTPException('Too many redirects: ' + url)
+
+
+    def close(self):
+        '''Close idle connections.'''
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+    def stats(self):
+        return '%d requests, %d connections, %d reused, %d bytes received, %d bytes decoded' % \
+            (self.requests, self.connections, self.reused, self.bytesReceived, self.bytesDecoded)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 
-from itertools import groupby
+import os
+import zipfile
+
+from itertools import chain, groupby
 from operator import attrgetter
 from subprocess import call
 
@@ -18,6 +21,12 @@ def htmlNode():
     return html
 
 
+def _element(tag, text=None, **attrib):
+    element = etree.Element(tag, attrib=attrib)
+    element.text = text
+    return element
+
+
 class KindleGen(object):
 
     TOC = 'periodical.html'
@@ -32,67 +41,83 @@ class KindleGen(object):
         'ncx' : 'application/x-dtbncx+xml'
         }
 
-    def __init__(self, program='kindlegen'):
+    # EPUB container
+    CONTAINER = 'META-INF/container.xml'
+    XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+    def __init__(self, program='kindlegen', format='mobi', compression=zipfile.ZIP_DEFLATED):
+        '''
+        Constructor
+        Arguments:
+        - `program`: kindlegen program making .mobi files
+        - `format`: 'mobi' by `program`, or 'epub' written in this process
+        - `compression`: zipfile compression of .epub files
+        '''
+        if format not in ('mobi', 'epub'):
+            raise ValueError('unknown book format `%s`' % (format,))
         self._program = program
+        self.format = format
+        self._compression = compression
 
 
-    def execute(self, title, date, entries):
+    def execute(self, title, date, entries, store=None, workdir='.'):
         '''
-        Generate .mobi file in periodical format.
+        Generate .mobi file in periodical format, or .epub file.
 
         Arguments:
         - `title`: ebook title
         - `date`: ebook date in format 'YYYY-MM-DD'
-        - `output`: output file name, exclude '.mobi'
-        - `entries`: list of maps having key ('feed_id', 'feed_title', 'entry_id', 'entry_title', 'author', 'path')
+        - `entries`: list of maps having key ('feed_id', 'feed_title', 'entry_id', 'entry_title', 'author', 'path', 'digest')
+        - `store`: store to write entries having 'digest' from, into `workdir`
+        - `workdir`: directory of the generated files
 
         Return:
-        Output filename
+        Output filename, relative to `workdir`
         '''
         if not len(entries):
             return
 
         book_id = title.replace(' ', '_')+'_'+date
 
-        self.generateTOC(entries)
-        self.generateOPF(book_id, title, date, entries)
-        self.generateNCX(book_id, title, entries)
-
-        output = book_id + '.mobi'
-        call([self._program, '-c2', '-o', output, self.OPF])
+        exported = []
+        if store is not None:
+            exported = store.export((e.digest for e in entries if e.get('digest')), workdir)
+        try:
+            self.generateTOC(entries, workdir)
+            self.generateNCX(book_id, title, entries, workdir)
+
+            output = book_id + '.' + self.format
+            if self.format == 'epub':
+                self.generateEPUB(book_id, title, date, entries, workdir, output)
+            else:
+                self.generateOPF(book_id, title, date, entries, workdir)
+                call([self._program, '-c2', '-o', output, self.OPF], cwd=workdir)
+        finally:
+            for path in exported:
+                os.remove(os.path.join(workdir, path))
         return output
 
 
-    def generateTOC(self, entries):
-        html = htmlNode()
-        body = etree.SubElement(html, 'body')
-        etree.SubElement(body,'h2').text = 'Table of Contents'
-
-        for section, articles in groupby(entries, attrgetter('feed_title')):
-            etree.SubElement(body, 'h4').text = section
-            for article in articles:
-                etree.SubElement(body, 'a', attrib={'href': article.path}).text = article.entry_title
-                etree.SubElement(body, 'br')
+    def generateTOC(self, entries, workdir='.'):
+        with etree.xmlfile(os.path.join(workdir, self.TOC), encoding='utf-8') as xf:
+            with xf.element('html'):
+                xf.write(htmlNode().find('head'), '\n')
+                with xf.element('body'):
+                    xf.write(_element('h2', 'Table of Contents'), '\n')
+                    for section, articles in groupby(entries, attrgetter('feed_title')):
+                        xf.write(_element('h4', section), '\n')
+                        for article in articles:
+                            xf.write(_element('a', article.entry_title, href=article.path),
+                                     _element('br'), '\n')
 
-        with open(self.TOC, 'w') as fo:
-            fo.write(etree.tostring(html,
-                                    pretty_print=True,
-                                    encoding='utf-8',
-                                    xml_declaration=False))
 
-
-    def generateOPF(self, book_id, title, date, entries):
+    def generateOPF(self, book_id, title, date, entries, workdir='.'):
         opf_namespace = 'http://www.idpf.org/2007/opf'
         dc_namespace = 'http://purl.org/dc/elements/1.1/'
         dc_metadata_nsmap = { 'dc' : dc_namespace }
         dc = '{{{0}}}'.format(dc_namespace)
 
-        package = etree.Element('{{{0}}}package'.format(opf_namespace),
-                                nsmap={None:opf_namespace},
-                                attrib={'version':'2.0',
-                                        'unique-identifier':book_id})
         metadata = etree.Element('metadata')
-        package.append(metadata)
 
         # etree.SubElement(metadata,'meta',attrib={'name':'cover',
         #                                           'content':cover[:-4]})
@@ -113,30 +138,7 @@ class KindleGen(object):
         etree.SubElement(x_metadata,'output',attrib={'encoding':'utf-8',
                                                      'content-type':'application/x-mobipocket-subscription-magazine'})
 
-        manifest = etree.SubElement(package,'manifest')
-        etree.SubElement(manifest, 'item',
-                         attrib={'id' : self.TOC,
-                                 'media-type' : self.MIME['html'],
-                                 'href' : self.TOC})
-        etree.SubElement(manifest, 'item',
-                         attrib={'id' : self.NCX,
-                                 'media-type' : self.MIME['ncx'],
-                                 'href' : self.NCX})
-
-        spine = etree.SubElement(package, 'spine',
-                                 attrib={'toc' : self.NCX})
-        etree.SubElement(spine, 'itemref',
-                         attrib={'idref': self.TOC})
-
-        for e in  entries:
-            etree.SubElement(manifest, 'item',
-                             attrib={'id' : str(e.entry_id),
-                                     'media-type' : self.MIME[e.path.split('.')[-1]],
-                                     'href' : e.path})
-            etree.SubElement(spine, 'itemref',
-                             attrib = {'idref' : str(e.entry_id)})
-
-        guide = etree.SubElement(package,'guide')
+        guide = etree.Element('guide')
         etree.SubElement(guide,'reference',
                          attrib={'type':'toc',
                                  'title':'Table of Contents',
@@ -146,34 +148,124 @@ class KindleGen(object):
                                  'title':'Welcome',
                                  'href':self.TOC})
 
-        with open(self.OPF, 'w') as fo:
-            fo.write(etree.tostring(package,
-                                    pretty_print=True,
-                                    encoding='utf-8',
-                                    xml_declaration=True))
-
-
-    def generateNavPoint (self, nav_point_node, label, source):
-        content = etree.Element('content', attrib={'src' : source})
-        text_element = etree.Element('text')
-        text_element.text = label
-        nav_label = etree.SubElement(nav_point_node, "navLabel")
-        nav_label.append(text_element)
-        nav_point_node.append(content)
-
-
-    def generateNCX (self, book_id, title, entries):
+        # entries are iterated twice, but never held in memory
+        with etree.xmlfile(os.path.join(workdir, self.OPF), encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('{{{0}}}package'.format(opf_namespace),
+                            nsmap={None:opf_namespace},
+                            attrib={'version':'2.0',
+                                    'unique-identifier':book_id}):
+                xf.write('\n', metadata, '\n')
+                with xf.element('manifest'):
+                    xf.write('\n',
+                             _element('item', id=self.TOC, href=self.TOC,
+                                      **{'media-type': self.MIME['html']}), '\n',
+                             _element('item', id=self.NCX, href=self.NCX,
+                                      **{'media-type': self.MIME['ncx']}), '\n')
+                    for e in entries:
+                        xf.write(_element('item', id=str(e.entry_id), href=e.path,
+                                          **{'media-type': self.MIME[e.path.split('.')[-1]]}), '\n')
+                xf.write('\n')
+                with xf.element('spine', toc=self.NCX):
+                    xf.write('\n', _element('itemref', idref=self.TOC), '\n')
+                    for e in entries:
+                        xf.write(_element('itemref', idref=str(e.entry_id)), '\n')
+                xf.write('\n', guide, '\n')
+
+
+    def generateEPUB(self, book_id, title, date, entries, workdir, output):
+        '''
+        Write .epub file `output` of the generated TOC and NCX and the entry files.
+        '''
+        opf_namespace = 'http://www.idpf.org/2007/opf'
+        dc_namespace = 'http://purl.org/dc/elements/1.1/'
+        dc = '{{{0}}}'.format(dc_namespace)
+        opf = '{{{0}}}'.format(opf_namespace)
+
+        metadata = etree.Element(opf+'metadata',
+                                 nsmap={'dc': dc_namespace, 'opf': opf_namespace})
+        etree.SubElement(metadata, dc+'identifier', attrib={'id': 'book_id'}).text = book_id
+        etree.SubElement(metadata, dc+'title').text = title
+        etree.SubElement(metadata, dc+'language').text = 'en-us'
+        etree.SubElement(metadata, dc+'creator').text = title
+        etree.SubElement(metadata, dc+'publisher').text = title
+        etree.SubElement(metadata, dc+'subject').text = 'News'
+        etree.SubElement(metadata, dc+'date').text = date
+
+        with etree.xmlfile(os.path.join(workdir, self.OPF), encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(opf+'package',
+                            nsmap={None: opf_namespace},
+                            attrib={'version': '2.0',
+                                    'unique-identifier': 'book_id'}):
+                xf.write('\n', metadata, '\n')
+                with xf.element(opf+'manifest'):
+                    xf.write('\n')
+                    with xf.element(opf+'item', id='ncx', href=self.NCX,
+                                    **{'media-type': self.MIME['ncx']}):
+                        pass
+                    with xf.element(opf+'item', id='toc', href=self.TOC,
+                                    **{'media-type': self.MIME['html']}):
+                        pass
+                    for e in entries:
+                        # ids of xml start with a letter
+                        with xf.element(opf+'item', id='e%s' % e.entry_id, href=e.path,
+                                        **{'media-type': self.MIME[e.path.split('.')[-1]]}):
+                            pass
+                        xf.write('\n')
+                xf.write('\n')
+                with xf.element(opf+'spine', toc='ncx'):
+                    xf.write('\n')
+                    with xf.element(opf+'itemref', idref='toc'):
+                        pass
+                    for e in entries:
+                        with xf.element(opf+'itemref', idref='e%s' % e.entry_id):
+                            pass
+                        xf.write('\n')
+
+        container = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+ <rootfiles>
+  <rootfile full-path="{0}" media-type="application/oebps-package+xml"/>
+ </rootfiles>
+</container>
+'''.format(self.OPF)
+
+        # ZipFile is not a context manager before python 2.7
+        epub = zipfile.ZipFile(os.path.join(workdir, output), 'w', self._compression)
+        try:
+            # mimetype is the first entry, not compressed
+            epub.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+            epub.writestr(self.CONTAINER, container)
+            epub.write(os.path.join(workdir, self.OPF), self.OPF)
+            epub.write(os.path.join(workdir, self.NCX), self.NCX)
+            epub.writestr(self.TOC, self._xhtml(os.path.join(workdir, self.TOC)))
+            for e in entries:
+                epub.writestr(e.path, self._xhtml(os.path.join(workdir, e.path)))
+        finally:
+            epub.close()
+
+
+    def _xhtml(self, path):
+        '''Return HTML file `path` serialized as XHTML.'''
+        html = etree.parse(path, etree.HTMLParser(encoding='utf-8')).getroot()
+        xhtml = etree.tostring(html, method='xml', encoding='utf-8', xml_declaration=True)
+        # the html parser leaves elements without namespace
+        return xhtml.replace('<html', '<html xmlns="%s"' % (self.XHTML_NAMESPACE,), 1)
+
+
+    def generateNavPoint (self, label, source):
+        '''Return navLabel and content elements of a navPoint.'''
+        nav_label = etree.Element("navLabel")
+        etree.SubElement(nav_label, 'text').text = label
+        return [nav_label, _element('content', src=source)]
+
+
+    def generateNCX (self, book_id, title, entries, workdir='.'):
         mbp_namespace = 'http://mobipocket.com/ns/mbp'
-
         ncx_namespace = 'http://www.daisy.org/z3986/2005/ncx/'
-        ncx_nsmap = { None: ncx_namespace, 'mbp': mbp_namespace }
 
-        ncx = etree.Element('ncx',
-                            nsmap=ncx_nsmap,
-                            attrib={'version' : '2005-1',
-                                    '{http://www.w3.org/XML/1998/namespace}lang' : 'en-US'})
-
-        head = etree.SubElement(ncx, 'head')
+        head = etree.Element('head')
         etree.SubElement(head,'meta',
                          attrib={'name' : 'dtb:uid',
                                  'content' : book_id })
@@ -187,49 +279,51 @@ class KindleGen(object):
                          attrib={'name' : 'dtb:maxPageNumber',
                                  'content' : '0' })
 
-        title_text_element = etree.Element('text')
-        title_text_element.text = title
-        author_text_element = etree.Element("text")
-        author_text_element.text = title
-
-        etree.SubElement(ncx,'docTitle').append(title_text_element)
-        etree.SubElement(ncx,'docAuthor').append(author_text_element)
-
-        nav_map = etree.SubElement(ncx,'navMap')
-
-        nav_point_periodical = etree.SubElement(nav_map, 'navPoint',
-                                                attrib={'class': 'periodical', 'id': 'periodical', 'playOrder': '0'})
-        self.generateNavPoint(nav_point_periodical, 'Table of Contents', self.TOC)
-
-        i = 1
-        scount = 0
-        for section, articles in groupby(entries, attrgetter('feed_title')):
-            scount = scount+1
-            articles = list(articles)
-            nav_point_section = etree.SubElement(nav_point_periodical,"navPoint",
-                                                 attrib={"class" : "section",
-                                                         "id" : ('sec_' + str(scount)),
-                                                         "playOrder" : str(i) })
-            self.generateNavPoint(nav_point_section, section, articles[0].path)
-            i += 1
-
-            acount = 0
-            for article in articles:
-                acount += 1
-                nav_point_article = etree.SubElement(nav_point_section,"navPoint",
-                                                     attrib={"class" : "article",
-                                                             "id" : ('art_' + str(scount) + '_' + str(acount)),
-                                                             "playOrder" : str(i) })
-                self.generateNavPoint(nav_point_article, article.entry_title, article.path)
-                i += 1
-
-        with open(self.NCX, 'w') as fo:
+        doc_title = etree.Element('docTitle')
+        etree.SubElement(doc_title, 'text').text = title
+        doc_author = etree.Element('docAuthor')
+        etree.SubElement(doc_author, 'text').text = title
+
+        with open(os.path.join(workdir, self.NCX), 'w') as fo:
             fo.write('<?xml version="1.0" encoding="utf-8"?>\n')
             fo.write('<!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN" "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">\n')
-            fo.write(etree.tostring(ncx,
-                                    pretty_print=True,
-                                    encoding="utf-8",
-                                    xml_declaration=False))
+            # xmlfile does not keep the xml prefix of xml:lang
+            fo.write('<ncx xmlns="{0}" xmlns:mbp="{1}" version="2005-1" xml:lang="en-US">\n'.format(
+                    ncx_namespace, mbp_namespace))
+            fo.write(''.join(etree.tostring(e, encoding='utf-8') + '\n'
+                             for e in (head, doc_title, doc_author)))
+            fo.write('<navMap><navPoint class="periodical" id="periodical" playOrder="0">\n')
+            fo.write(''.join(etree.tostring(e, encoding='utf-8')
+                             for e in self.generateNavPoint('Table of Contents', self.TOC)) + '\n')
+
+            i = 1
+            scount = 0
+            for section, articles in groupby(entries, attrgetter('feed_title')):
+                scount = scount+1
+                # section points to its first article
+                first = next(articles)
+                # one document per section, its articles are streamed
+                with etree.xmlfile(fo, encoding='utf-8') as xf:
+                    with xf.element("navPoint",
+                                    attrib={"class" : "section",
+                                            "id" : ('sec_' + str(scount)),
+                                            "playOrder" : str(i) }):
+                        xf.write(*self.generateNavPoint(section, first.path))
+                        xf.write('\n')
+                        i += 1
+
+                        acount = 0
+                        for article in chain([first], articles):
+                            acount += 1
+                            with xf.element("navPoint",
+                                            attrib={"class" : "article",
+                                                    "id" : ('art_' + str(scount) + '_' + str(acount)),
+                                                    "playOrder" : str(i) }):
+                                xf.write(*self.generateNavPoint(article.entry_title, article.path))
+                            xf.write('\n')
+                            i += 1
+                fo.write('\n')
+            fo.write('</navPoint></navMap>\n</ncx>\n')
 
 
 # Local Variables: **
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+Send books as mail attachments, many over one SMTP connection.
+
+    >>> import tempfile, shutil
+    >>> from testserver import SmtpSink
+    >>> dirname = tempfile.mkdtemp()
+    >>> book = os.path.join(dirname, 'book.mobi')
+    >>> with open(book, 'wb') as fo:
+    ...     fo.write('MOBI')
+    >>> with SmtpSink() as sink:
+    ...     with SmtpMailer(port=sink.port) as mailer:
+    ...         for to in ('a@example.com', 'b@example.com'):
+    ...             mailer.send(to, 'feed2mobi daily delivery', book, 'Feed2Mobi_2012-05-01.mobi')
+    >>> sink.connections, [to for frm, to, data in sink.messages]
+    (1, [['a@example.com'], ['b@example.com']])
+    >>> 'filename="Feed2Mobi_2012-05-01.mobi"' in sink.messages[0][2]
+    True
+    >>> shutil.rmtree(dirname)
+'''
+
+import os
+import os.path
+import smtplib
+import socket
+
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+
+
+class SmtpMailer(object):
+    '''
+    Send mails through the SMTP server at `host`:`port`, connected on first
+    mail and reconnected after the connection is lost.
+    '''
+
+    # errors after which the connection is not usable
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+    def __init__(self, host='127.0.0.1', port=25, sender='feed2mobi@skypiea.info',
+                 username=None, password=None, starttls=False, timeout=30):
+        self._host = host
+        self._port = port
+        self._sender = sender
+        self._username = username
+        self._password = password
+        self._starttls = starttls
+        self._timeout = timeout
+        self._smtp = None
+
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self._host, self._port, timeout=self._timeout)
+        if self._starttls:
+            smtp.starttls()
+        if self._username:
+            smtp.login(self._username, self._password)
+        return smtp
+
+
+    def send(self, to, subject, path, name):
+        '''Send file `path` attached as `name` to address `to`.'''
+        msg = MIMEMultipart()
+        msg['From'] = self._sender
+        msg['To'] = to
+        msg['Subject'] = subject
+        attachment = MIMEBase('application', 'octet-stream')
+        with open(path, 'rb') as fi:
+            attachment.set_payload(fi.read())
+        encoders.encode_base64(attachment)
+        attachment.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(attachment)
+
+        if self._smtp is None:
+            self._smtp = self._connect()
+        try:
+            self._smtp.sendmail(self._sender, [to], msg.as_string())
+        except self.CONNECTION_ERRORS:
+            self.close()
+            raise
+
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except self.CONNECTION_ERRORS:
+                self._smtp.close()
+            self._smtp = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
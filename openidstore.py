@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+OpenID store of associations and nonces in tables of the sqlite database
+of the app, shared by its processes.
+
+    >>> import tempfile, shutil
+    >>> from openid.association import Association
+    >>> dirname = tempfile.mkdtemp()
+    >>> db = web.database(dbn='sqlite', db=os.path.join(dirname, 'test.db'))
+    >>> store = SqliteOpenIDStore(db)
+    >>> server = 'https://www.google.com/accounts/o8/ud'
+    >>> store.getAssociation(server) is None
+    True
+    >>> old = Association.fromExpiresIn(600, 'h1', 'secret1', 'HMAC-SHA1')
+    >>> store.storeAssociation(server, old)
+    >>> new = Association.fromExpiresIn(600, 'h2', 'secret2', 'HMAC-SHA1')
+    >>> new.issued += 1
+    >>> store.storeAssociation(server, new)
+    >>> store.getAssociation(server).handle, store.getAssociation(server, 'h1').secret
+    ('h2', 'secret1')
+
+The latest association of a server is read from the cache until removed,
+associations of handles checking responses are always read from the table:
+
+    >>> count = db.ctx.dbq_count
+    >>> store.getAssociation(server) == new, db.ctx.dbq_count - count
+    (True, 0)
+    >>> store.getAssociation(server, 'h1') == old, db.ctx.dbq_count - count
+    (True, 1)
+    >>> store.removeAssociation(server, 'h2'), store.removeAssociation(server, 'h2')
+    (True, False)
+    >>> store.getAssociation(server).handle
+    'h1'
+    >>> SqliteOpenIDStore(db).removeAssociation(server, 'h1')
+    True
+    >>> store.getAssociation(server, 'h1') is None
+    True
+    >>> store.storeAssociation(server, old)
+    >>> _ = db.update('openid_association', where='1=1', expires_at=0)
+    >>> store.cleanupAssociations()
+    1
+    >>> store.getAssociation(server, 'h1') is None
+    True
+
+A nonce is used once, within the clock skew:
+
+    >>> now = int(time.time())
+    >>> store.useNonce(server, now, 'salt'), store.useNonce(server, now, 'salt')
+    (True, False)
+    >>> store.useNonce(server, now - 2 * nonce.SKEW, 'salt')
+    False
+    >>> _ = db.update('openid_nonce', where='1=1', timestamp=now - 2 * nonce.SKEW)
+    >>> store.cleanupNonces()
+    1
+    >>> shutil.rmtree(dirname)
+'''
+
+import base64
+import os
+import os.path
+import sqlite3
+import time
+
+import web
+
+from cache import TtlCache
+from openid.association import Association
+from openid.store import nonce
+from openid.store.interface import OpenIDStore
+
+
+class SqliteOpenIDStore(OpenIDStore):
+    '''
+    Keep associations and nonces in tables of `db`. The latest association
+    of a server, used to start authentications, is cached by `ttl`
+    seconds: other processes may use it for up to `ttl` seconds after it
+    is removed, until the server tells it invalid. Associations looked up
+    by handle, to check responses, are not cached.
+    '''
+
+    _INIT_SQLS = ['''
+CREATE TABLE IF NOT EXISTS openid_association
+(
+ server_url TEXT NOT NULL,
+ handle TEXT NOT NULL,
+ secret TEXT NOT NULL,
+ issued INTEGER NOT NULL,
+ lifetime INTEGER NOT NULL,
+ assoc_type TEXT NOT NULL,
+ expires_at INTEGER NOT NULL,
+ CONSTRAINT pk_openid_association PRIMARY KEY (server_url, handle)
+)
+''',
+'''
+CREATE TABLE IF NOT EXISTS openid_nonce
+(
+ server_url TEXT NOT NULL,
+ timestamp INTEGER NOT NULL,
+ salt TEXT NOT NULL,
+ CONSTRAINT pk_openid_nonce PRIMARY KEY (server_url, timestamp, salt)
+)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_openid_association_expires_at ON openid_association (expires_at)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_openid_nonce_timestamp ON openid_nonce (timestamp)
+''']
+
+    def __init__(self, db, ttl=60):
+        self._db = db
+        # latest issued associations by server url
+        self._associations = TtlCache(maxSize=100, ttl=ttl)
+        for sql in self._INIT_SQLS:
+            db.query(sql)
+
+
+    def storeAssociation(self, server_url, association):
+        self._db.query('INSERT OR REPLACE INTO openid_association'
+                       ' (server_url, handle, secret, issued, lifetime, assoc_type, expires_at)'
+                       ' VALUES ($server_url, $handle, $secret, $issued, $lifetime, $assoc_type, $expires_at)',
+                       vars={'server_url': server_url,
+                             'handle': association.handle,
+                             'secret': base64.b64encode(association.secret),
+                             'issued': association.issued,
+                             'lifetime': association.lifetime,
+                             'assoc_type': association.assoc_type,
+                             'expires_at': association.issued + association.lifetime})
+        self._associations.invalidate(server_url)
+
+
+    def getAssociation(self, server_url, handle=None):
+        association = None
+        if handle is None:
+            association = self._associations.get(server_url)
+        if association is None or association.getExpiresIn() == 0:
+            now = int(time.time())
+            where = 'server_url=$server_url AND expires_at>$now'
+            if handle is not None:
+                where += ' AND handle=$handle'
+            found = list(self._db.select('openid_association',
+                                         what='handle, secret, issued, lifetime, assoc_type',
+                                         where=where, order='issued DESC',
+                                         limit=1, vars=locals()))
+            if not found:
+                return None
+            row = found[0]
+            # python-openid signs with str, sqlite returns unicode
+            association = Association(str(row.handle), base64.b64decode(row.secret),
+                                      row.issued, row.lifetime, str(row.assoc_type))
+            if handle is None:
+                self._associations.put(server_url, association)
+        return association
+
+
+    def removeAssociation(self, server_url, handle):
+        self._associations.invalidate(server_url)
+        return bool(self._db.delete('openid_association',
+                                    where='server_url=$server_url AND handle=$handle',
+                                    vars=locals()))
+
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+        try:
+            self._db.insert('openid_nonce', False, server_url=server_url,
+                            timestamp=int(timestamp), salt=salt)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+
+    def cleanupNonces(self):
+        return self._db.delete('openid_nonce', where='timestamp<$expired',
+                               vars={'expired': int(time.time()) - nonce.SKEW})
+
+
+    def cleanupAssociations(self):
+        self._associations.invalidate()
+        return self._db.delete('openid_association', where='expires_at<=$now',
+                               vars={'now': int(time.time())})
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+Timings and counts of the stages of update, kindlegen and deliver runs,
+per feed and per account, kept in table run_log and exposed in the text
+format of Prometheus.
+
+    >>> import tempfile, shutil
+    >>> dirname = tempfile.mkdtemp()
+    >>> db = web.database(dbn='sqlite', db=os.path.join(dirname, 'test.db'))
+    >>> now = [1000.0]
+    >>> log = RunLog(db, 'update', clock=lambda: now[0])
+    >>> with log.timer('fetch', feedId=1, status=200) as values:
+    ...     now[0] += 0.5
+    ...     values['bytes'] = 2048
+    >>> with log.timer('fetch', feedId=2):
+    ...     raise IOError('timed out')
+    Traceback (most recent call last):
+    ...
+    IOError: timed out
+    >>> log.record('save', 0.25, feedId=1, entries=3, updated=1)
+    >>> log.save()
+    3
+    >>> log.save()
+    0
+    >>> [(r.stage, r.feed_id, r.seconds, r.bytes, r.error) for r in db.select('run_log', order='id')]
+    [(u'fetch', 1, 0.5, 2048, None), (u'fetch', 2, 0.0, None, u'IOError: timed out'), (u'save', 1, 0.25, None, None)]
+    >>> text = exposition(db, now=now[0])
+    >>> print '\\n'.join(l for l in text.splitlines() if 'fetch' in l and not l.startswith('#'))
+    feed2mobi_stage_seconds_sum{job="update",stage="fetch"} 0.5
+    feed2mobi_stage_seconds_count{job="update",stage="fetch"} 2
+    feed2mobi_stage_bytes{job="update",stage="fetch"} 2048
+    feed2mobi_stage_errors{job="update",stage="fetch"} 1
+    feed2mobi_fetch_status{status="200"} 1
+    >>> print '\\n'.join(l for l in text.splitlines() if l.startswith('feed2mobi_feed'))
+    feed2mobi_feed_seconds{feed_id="1"} 0.75
+    feed2mobi_feed_seconds{feed_id="2"} 0.0
+    >>> 'feed2mobi_last_run_timestamp_seconds{job="update"} 1000' in text
+    True
+    >>> expire(db, 1, now=now[0] + 2 * 86400)
+    3
+    >>> shutil.rmtree(dirname)
+'''
+
+import os
+import os.path
+import threading
+import time
+
+import web
+
+
+_INIT_SQLS = ['''
+CREATE TABLE IF NOT EXISTS run_log
+(
+ id INTEGER PRIMARY KEY AUTOINCREMENT,
+ job TEXT NOT NULL,
+ run_at INTEGER NOT NULL,
+ stage TEXT NOT NULL,
+ feed_id INTEGER,
+ account_id INTEGER,
+ seconds REAL NOT NULL,
+ bytes INTEGER,
+ status INTEGER,
+ entries INTEGER,
+ updated INTEGER,
+ error TEXT
+)
+''',
+'''
+CREATE INDEX IF NOT EXISTS ix_run_log_run_at ON run_log (run_at)
+''']
+
+_COLUMNS = ('job', 'run_at', 'stage', 'feed_id', 'account_id', 'seconds',
+            'bytes', 'status', 'entries', 'updated', 'error')
+
+
+def init(db):
+    for sql in _INIT_SQLS:
+        db.query(sql)
+
+
+class RunLog(object):
+    '''
+    Metrics of a run of `job`, recorded by any thread, saved into table
+    run_log by the thread writing the database.
+    '''
+
+    def __init__(self, db, job, clock=time.time):
+        self._db = db
+        self._job = job
+        self._clock = clock
+        self._runAt = int(clock())
+        self._rows = []
+        self._lock = threading.Lock()
+        init(db)
+
+
+    def record(self, stage, seconds, feedId=None, accountId=None, bytes=None,
+               status=None, entries=None, updated=None, error=None):
+        row = (self._job, self._runAt, stage, feedId, accountId, seconds,
+               bytes, status, entries, updated, error)
+        with self._lock:
+            self._rows.append(row)
+
+
+    def timer(self, stage, **values):
+        '''
+        Return context manager recording seconds spent in its block as
+        `stage` with `values`, and the error raised by the block.
+        The dict of values is given to the block to add more.
+        '''
+        log = self
+
+        class Timer(object):
+            def __enter__(self):
+                self._start = log._clock()
+                return values
+            def __exit__(self, exc_type, exc_value, traceback):
+                if exc_type is not None:
+                    values['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+                log.record(stage, log._clock() - self._start, **values)
+        return Timer()
+
+
+    def save(self):
+        '''Insert metrics recorded since last saved, return count of them.'''
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            cursor = self._db.ctx.db.cursor()
+            try:
+                cursor.executemany('INSERT INTO run_log (%s) VALUES (%s)'
+                                   % (', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                                   rows)
+            finally:
+                cursor.close()
+            self._db.ctx.db.commit()
+        return len(rows)
+
+
+def expire(db, days, now=None):
+    '''Delete metrics of runs older than `days`, return count of them.'''
+    init(db)
+    before = int((now or time.time()) - days * 86400)
+    return db.delete('run_log', where='run_at<$before', vars=locals())
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    return u'%s{%s} %s' % (name,
+                           ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels),
+                           repr(value) if isinstance(value, float) else value)
+
+
+def exposition(db, window=86400, top=20, now=None):
+    '''
+    Return metrics of runs within `window` seconds, as Prometheus text:
+    totals by job and stage, HTTP status of fetches, time of last runs,
+    and the `top` feeds and accounts taking most time.
+    '''
+    init(db)
+    since = int((now or time.time()) - window)
+    lines = []
+
+    def family(name, kind, help, samples):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.extend(_sample(*s) for s in samples)
+
+    stages = list(db.query('''
+SELECT job, stage, sum(seconds) seconds, count(*) count, sum(bytes) bytes,
+ count(error) errors, sum(entries) entries, sum(updated) updated
+FROM run_log WHERE run_at>=$since GROUP BY job, stage ORDER BY job, stage''', vars=locals()))
+    byStage = lambda s: (('job', s.job), ('stage', s.stage))
+    lines.append('# HELP feed2mobi_stage_seconds Seconds spent in stages of runs')
+    lines.append('# TYPE feed2mobi_stage_seconds summary')
+    for s in stages:
+        lines.append(_sample('feed2mobi_stage_seconds_sum', byStage(s), float(s.seconds)))
+        lines.append(_sample('feed2mobi_stage_seconds_count', byStage(s), s.count))
+    family('feed2mobi_stage_bytes', 'gauge', 'Bytes fetched, built or sent by stages of runs',
+           [('feed2mobi_stage_bytes', byStage(s), s.bytes) for s in stages if s.bytes is not None])
+    family('feed2mobi_stage_errors', 'gauge', 'Errors in stages of runs',
+           [('feed2mobi_stage_errors', byStage(s), s.errors) for s in stages])
+    family('feed2mobi_stage_entries', 'gauge', 'Entries saved, built or queued by stages of runs',
+           [('feed2mobi_stage_entries', byStage(s), s.entries) for s in stages if s.entries is not None])
+    family('feed2mobi_stage_updated_entries', 'gauge', 'Entries updated by stages of runs',
+           [('feed2mobi_stage_updated_entries', byStage(s), s.updated) for s in stages if s.updated is not None])
+    family('feed2mobi_fetch_status', 'gauge', 'Fetches by HTTP status',
+           [('feed2mobi_fetch_status', (('status', r.status),), r.count)
+            for r in db.query('''
+SELECT status, count(*) count FROM run_log
+WHERE run_at>=$since AND stage='fetch' AND status IS NOT NULL
+GROUP BY status ORDER BY status''', vars=locals())])
+    family('feed2mobi_last_run_timestamp_seconds', 'gauge', 'Start time of last runs',
+           [('feed2mobi_last_run_timestamp_seconds', (('job', r.job),), r.run_at)
+            for r in db.query('SELECT job, max(run_at) run_at FROM run_log GROUP BY job ORDER BY job')])
+    for subject in ('feed', 'account'):
+        family('feed2mobi_%s_seconds' % subject, 'gauge',
+               'Seconds spent for the %d %ss taking most time' % (top, subject),
+               [('feed2mobi_%s_seconds' % subject, (('%s_id' % subject, r.id),), float(r.seconds))
+                for r in db.query('''
+SELECT %(subject)s_id id, sum(seconds) seconds FROM run_log
+WHERE run_at>=$since AND %(subject)s_id IS NOT NULL
+GROUP BY %(subject)s_id ORDER BY sum(seconds) DESC, %(subject)s_id LIMIT $top''' % locals(),
+                                  vars=locals())])
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
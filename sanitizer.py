@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Clean HTML of feed entries for .mobi in one walk of the element tree.
+
+    >>> from lxml import etree
+    >>> html = etree.HTML('<p onclick="go()">a<img src="i.png"/>b<script>go()</script>c'
+    ...                   '<!-- note -->d<a href="#"><img src="i.png"/></a>e'
+    ...                   '<a href="javascript:go()" onmouseover="go()">link</a>'
+    ...                   '<iframe src="f.html"></iframe>f<style>p {}</style></p>')
+    >>> clean(html)
+    >>> etree.tostring(html.find('body'))
+    '<body><p>abcde<a>link</a>f</p></body>'
+'''
+
+from lxml import etree
+
+
+# elements removed with their content
+REMOVED_TAGS = frozenset(['img', 'script', 'style', 'iframe', 'frame', 'frameset',
+                          'object', 'embed', 'applet', 'noscript'])
+
+# attributes dropped if their value is a script
+URL_ATTRIBUTES = frozenset(['href', 'src', 'action'])
+
+
+def _remove(parent, node):
+    '''Remove `node` from `parent`, keeping its tail text.'''
+    if node.tail:
+        previous = node.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + node.tail
+        else:
+            parent.text = (parent.text or '') + node.tail
+    parent.remove(node)
+
+
+def clean(node):
+    '''
+    Remove images, scripts, styles, frames, comments, processing
+    instructions, event handler attributes and empty links under `node`.
+    '''
+    # follow sibling links, indexing children is linear in lxml
+    child = node[0] if len(node) else None
+    while child is not None:
+        following = child.getnext()
+        tag = child.tag
+        if not isinstance(tag, basestring) or tag in REMOVED_TAGS:
+            # comments and processing instructions have function tags
+            _remove(node, child)
+        else:
+            for name in child.keys():
+                if name[:2] == 'on' or (name in URL_ATTRIBUTES and
+                                        child.get(name).strip().lower().startswith('javascript:')):
+                    del child.attrib[name]
+            if len(child):
+                clean(child)
+            if tag == 'a' and not child.text and not len(child):
+                _remove(node, child)
+        child = following
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+Adaptive polling schedule of feeds.
+
+A feed is fetched again after its observed update interval; each check
+finding it unchanged doubles the wait, up to `maxInterval`.
+
+    >>> s = FeedScheduler(minInterval=600, maxInterval=86400, jitter=0)
+    >>> s.changed(now=10000, lastChangedAt=None, interval=None)
+    (600, 10600)
+    >>> s.changed(now=20000, lastChangedAt=10000, interval=600)
+    (5300, 25300)
+    >>> [s.unchanged(now=20000, interval=5300, unchangedCount=n) for n in (1, 2, 3, 5)]
+    [30600, 41200, 62400, 106400]
+
+Failed fetches are retried on schedule a few times, then the wait doubles
+on each failure, up to `maxBackoff`; after `maxFailures` the feed is given
+up:
+
+    >>> s = FeedScheduler(minInterval=600, jitter=0, retries=2, maxBackoff=86400, maxFailures=10)
+    >>> [s.failed(now=0, interval=1200, failureCount=n) for n in (1, 2, 3, 4, 9, 10)]
+    [1200, 1200, 2400, 4800, 86400, None]
+
+Jitter spreads fetches of feeds having the same interval, within the
+bounds of intervals:
+
+    >>> s = FeedScheduler(minInterval=600, maxInterval=3600, jitter=0.1)
+    >>> fetchAts = set(s.changed(0, None, 1200)[1] for i in range(20))
+    >>> len(fetchAts) > 1, min(fetchAts) >= 1080, max(fetchAts) <= 1320
+    (True, True, True)
+    >>> waits = [s.unchanged(0, 3600, 1) for i in range(20)] + [s.changed(0, None, 600)[1] for i in range(20)]
+    >>> min(waits) >= 600, max(waits) <= 3600
+    (True, True)
+'''
+
+import random
+
+
+class FeedScheduler(object):
+
+    def __init__(self, minInterval=30*60, maxInterval=24*3600, jitter=0.1,
+                 retries=3, maxBackoff=7*24*3600, maxFailures=20):
+        """
+        Constructor
+        Arguments:
+        - `minInterval`: min seconds between fetches of a feed
+        - `maxInterval`: max seconds between fetches of a feed
+        - `jitter`: fraction of the wait randomly added or subtracted
+        - `retries`: failures in a row retried at the update interval
+        - `maxBackoff`: max seconds between fetches of a failing feed
+        - `maxFailures`: failures in a row to give up a feed
+        """
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._jitter = jitter
+        self._retries = retries
+        self._maxBackoff = maxBackoff
+        self._maxFailures = maxFailures
+
+
+    def _clamp(self, interval):
+        return int(min(self._maxInterval, max(self._minInterval, interval)))
+
+
+    def _at(self, now, wait, maxWait=None):
+        '''Return time `wait` seconds from `now` with jitter, within the bounds.'''
+        if self._jitter:
+            wait = wait * (1 + self._jitter * (2 * random.random() - 1))
+        return int(now + min(maxWait or self._maxInterval, max(self._minInterval, wait)))
+
+
+    def changed(self, now, lastChangedAt, interval):
+        '''
+        Return tuple of update interval and next fetch time of a feed
+        found changed at `now`, last changed at `lastChangedAt` with
+        update interval `interval`.
+        '''
+        if lastChangedAt is None:
+            interval = interval or self._minInterval
+        elif interval is None:
+            interval = now - lastChangedAt
+        else:
+            # moving average of observed intervals
+            interval = (interval + now - lastChangedAt) / 2
+        interval = self._clamp(interval)
+        return (interval, self._at(now, interval))
+
+
+    def unchanged(self, now, interval, unchangedCount):
+        '''
+        Return next fetch time of a feed found unchanged `unchangedCount`
+        times in a row, with update interval `interval`.
+        '''
+        wait = (interval or self._minInterval) * 2 ** min(unchangedCount, 16)
+        return self._at(now, self._clamp(wait))
+
+
+    def failed(self, now, interval, failureCount):
+        '''
+        Return next fetch time of a feed failed `failureCount` times in
+        a row, with update interval `interval`, or None to give it up.
+        '''
+        if failureCount >= self._maxFailures:
+            return None
+        wait = self._clamp(interval or self._minInterval)
+        if failureCount <= self._retries:
+            return self._at(now, wait)
+        maxWait = max(self._maxInterval, self._maxBackoff)
+        wait = min(maxWait, wait * 2 ** min(failureCount - self._retries, 16))
+        return self._at(now, wait, maxWait)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
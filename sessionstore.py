@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+'''
+Session store of web.py in a table of the sqlite database of the app.
+
+    >>> import tempfile, shutil
+    >>> dirname = tempfile.mkdtemp()
+    >>> db = web.database(dbn='sqlite', db=os.path.join(dirname, 'test.db'))
+    >>> now = [1000]
+    >>> store = SqliteStore(db, timeout=100, flushInterval=10, clock=lambda: now[0])
+    >>> 'abc' in store
+    False
+    >>> store['abc'] = {'ip': '127.0.0.1'}
+    >>> 'abc' in store, store['abc']
+    (True, {'ip': '127.0.0.1'})
+
+Saving an unchanged session only notes its access time, written with
+others after `flushInterval`:
+
+    >>> now[0] = 1005
+    >>> store['abc'] = store['abc']
+    >>> db.select('session', what='atime')[0].atime
+    1000
+    >>> now[0] = 1011
+    >>> store['abc'] = {'ip': '127.0.0.1'}
+    >>> db.select('session', what='atime')[0].atime
+    1011
+    >>> store['abc'] = {'ip': '127.0.0.1', 'webpy_return_to': '/'}
+    >>> sorted(store['abc'])
+    ['ip', 'webpy_return_to']
+
+A session deleted by another process is not found, even if accessed:
+
+    >>> other = SqliteStore(db, timeout=100, flushInterval=10, clock=lambda: now[0])
+    >>> store['abc'] = {'ip': '127.0.0.1'}
+    >>> del other['abc']
+    >>> 'abc' in store
+    False
+    >>> store['abc']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'abc'
+
+Expired sessions are deleted in batches:
+
+    >>> store['abc'] = {'ip': '127.0.0.2'}
+    >>> for i in range(5):
+    ...     store['%x' % i] = {}
+    >>> now[0] = 1080
+    >>> store.cleanup(50)
+    6
+    >>> store['abc'] = {}
+    >>> now[0] = 1200
+    >>> 'abc' in store
+    False
+    >>> store.cleanup(100)
+    1
+    >>> del store['abc']
+    >>> shutil.rmtree(dirname)
+'''
+
+import os
+import os.path
+import threading
+import time
+
+import web
+import web.session
+
+from cache import TtlCache
+
+
+class SqliteStore(web.session.Store):
+    '''
+    Keep sessions in table `table` of `db`, expiring `timeout` seconds
+    after last access, `web.config.session_parameters.timeout` by default.
+
+    Accesses which do not change a session are noted in memory and written
+    together every `flushInterval` seconds, so a session may expire up to
+    `flushInterval` earlier if the process exits.
+    '''
+
+    _INIT_SQL = '''
+CREATE TABLE IF NOT EXISTS %(table)s
+(
+ session_id TEXT NOT NULL PRIMARY KEY,
+ data TEXT,
+ atime INTEGER NOT NULL,
+ expires_at INTEGER NOT NULL
+)
+'''
+
+    _INDEX_SQL = '''
+CREATE INDEX IF NOT EXISTS ix_%(table)s_expires_at ON %(table)s (expires_at)
+'''
+
+    def __init__(self, db, table='session', timeout=None, flushInterval=60,
+                 batch=500, clock=time.time):
+        self._db = db
+        self._table = table
+        self._timeout = timeout or web.config.session_parameters.timeout
+        self._flushInterval = flushInterval
+        self._batch = batch
+        self._clock = clock
+        # data last read or written by this process, to skip unchanged writes
+        self._known = TtlCache(maxSize=10000, ttl=self._timeout)
+        # access times not written yet, by session id
+        self._touched = {}
+        self._flushedAt = clock()
+        self._lock = threading.Lock()
+        db.query(self._INIT_SQL % {'table': table})
+        db.query(self._INDEX_SQL % {'table': table})
+
+
+    def _where(self, key):
+        '''
+        Return condition of the row of session `key` not expired, by its
+        access time noted in memory if any, as it is not written yet.
+        '''
+        if self._touched.get(key, 0) + self._timeout > self._clock():
+            return 'session_id=$key'
+        return 'session_id=$key AND expires_at>$now'
+
+
+    def __contains__(self, key):
+        # same rows as __getitem__, as web.py reads a session found here
+        now = self._clock()
+        return bool(list(self._db.select(self._table, what='1',
+                                         where=self._where(key), vars=locals())))
+
+
+    def __getitem__(self, key):
+        now = self._clock()
+        found = list(self._db.select(self._table, what='data',
+                                     where=self._where(key), vars=locals()))
+        if not found:
+            raise KeyError(key)
+        self._known.put(key, found[0].data)
+        self._touch(key)
+        return self.decode(found[0].data)
+
+
+    def __setitem__(self, key, value):
+        data = self.encode(value)
+        if self._known.get(key) == data:
+            self._touch(key)
+            return
+        now = int(self._clock())
+        self._db.query('INSERT OR REPLACE INTO %s (session_id, data, atime, expires_at)'
+                       ' VALUES ($key, $data, $now, $expires)' % (self._table,),
+                       vars={'key': key, 'data': data, 'now': now,
+                             'expires': now + self._timeout})
+        self._known.put(key, data)
+        with self._lock:
+            self._touched.pop(key, None)
+
+
+    def __delitem__(self, key):
+        self._db.delete(self._table, where='session_id=$key', vars=locals())
+        self._known.invalidate(key)
+        with self._lock:
+            self._touched.pop(key, None)
+
+
+    def _touch(self, key):
+        now = self._clock()
+        with self._lock:
+            self._touched[key] = int(now)
+            if now - self._flushedAt < self._flushInterval:
+                return
+        self.flush()
+
+
+    def flush(self):
+        '''Write access times noted in memory.'''
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._flushedAt = self._clock()
+        if not touched:
+            return
+        db = self._db
+        with db.transaction():
+            for key, atime in touched.iteritems():
+                db.update(self._table, where='session_id=$key',
+                          atime=atime, expires_at=atime + self._timeout,
+                          vars=locals())
+
+
+    def cleanup(self, timeout):
+        '''
+        Delete sessions not accessed for `timeout` seconds, return count
+        of deleted sessions.
+        '''
+        self.flush()
+        # rows expire `self._timeout` after access
+        expired = self._clock() - timeout + self._timeout
+        deleted = 0
+        while True:
+            count = self._db.query('''
+DELETE FROM %s WHERE session_id IN
+ (SELECT session_id FROM %s WHERE expires_at<=$expired LIMIT $batch)''' % (self._table, self._table),
+                                   vars={'expired': expired, 'batch': self._batch})
+            deleted += count
+            if count < self._batch:
+                return deleted
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
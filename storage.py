@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+SQLite database of web.py tuned for a web process and batch processes
+sharing the same file.
+
+    >>> import tempfile, shutil
+    >>> dirname = tempfile.mkdtemp()
+    >>> db = database(os.path.join(dirname, 'test.db'), cacheSize=-2000)
+    >>> [db.query('PRAGMA %s' % p)[0].values()[0] for p in ('journal_mode', 'synchronous', 'cache_size')]
+    [u'wal', 1, -2000]
+
+The connection of a thread is kept after web.py clears its thread
+contexts at the end of a request:
+
+    >>> connection = db.ctx.db
+    >>> web.utils.ThreadedDict.clear_all()
+    >>> db.ctx.db is connection
+    True
+    >>> shutil.rmtree(dirname)
+'''
+
+import os
+import os.path
+import sqlite3
+import threading
+
+import web
+import web.db
+
+
+class SqliteDB(web.db.SqliteDB):
+    '''
+    web.py sqlite database keeping one connection per thread, if `reuse`,
+    instead of one per request.
+    '''
+
+    def __init__(self, reuse=True, **keywords):
+        web.db.SqliteDB.__init__(self, **keywords)
+        self._reuse = reuse
+        self._local = threading.local()
+
+
+    def _getctx(self):
+        if not self._reuse:
+            return web.db.SqliteDB._getctx(self)
+        ctx = getattr(self._local, 'ctx', None)
+        if ctx is None:
+            ctx = self._local.ctx = web.storage()
+            self._load_context(ctx)
+        return ctx
+    ctx = property(_getctx)
+
+
+def _connectionFactory(pragmas):
+    class Connection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            sqlite3.Connection.__init__(self, *args, **kwargs)
+            for pragma in pragmas:
+                self.execute('PRAGMA ' + pragma).fetchall()
+    return Connection
+
+
+def database(path, journalMode='wal', synchronous='normal', cacheSize=-16000,
+             mmapSize=64*1024*1024, busyTimeout=10.0, reuse=True):
+    """
+    Return web.py database of sqlite file `path`.
+
+    Arguments:
+    - `journalMode`: journal_mode, readers are not blocked by the writer in 'wal'
+    - `synchronous`: synchronous, 'normal' is durable enough in 'wal'
+    - `cacheSize`: cache_size, pages or negative KiB
+    - `mmapSize`: mmap_size in bytes, 0 to read by system calls
+    - `busyTimeout`: seconds to wait for a lock before raising
+    - `reuse`: keep the connection of a thread between requests
+    """
+    pragmas = ['journal_mode=%s' % (journalMode,),
+               'synchronous=%s' % (synchronous,),
+               'cache_size=%d' % (cacheSize,),
+               'mmap_size=%d' % (mmapSize,)]
+    return SqliteDB(db=path, reuse=reuse, timeout=busyTimeout,
+                    factory=_connectionFactory(pragmas))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+'''
+Content addressed store of rendered entries, shared by all feeds.
+
+PackStore appends entries to a pack file per day, indexed in SQLite:
+
+    >>> import tempfile, shutil
+    >>> import web
+    >>> datapath = tempfile.mkdtemp()
+    >>> db = web.database(dbn='sqlite', db=os.path.join(datapath, 'store.db'))
+    >>> store = PackStore(db, datapath)
+    >>> digest = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    >>> store.path(digest)
+    'entries/da39a3ee5e6b4b0d3255bfef95601890afd80709.html'
+    >>> for i in range(4):
+    ...     store.put('%040x' % i, '<p>%d</p>' % i)
+    >>> store.read('%040x' % 2), store.read(digest)
+    ('<p>2</p>', None)
+    >>> os.listdir(os.path.join(datapath, 'packs')) == [store.segment() + '.pack']
+    True
+
+Only the entries of a bundle are written into the working directory of kindlegen:
+
+    >>> workdir = tempfile.mkdtemp()
+    >>> store.export(['%040x' % 1, '%040x' % 3], workdir)
+    ['entries/0000000000000000000000000000000000000001.html', 'entries/0000000000000000000000000000000000000003.html']
+    >>> len(os.listdir(os.path.join(workdir, 'entries')))
+    2
+
+Packs of removed entries are rewritten, once the active pack of today has changed:
+
+    >>> for i in range(3):
+    ...     store.remove('%040x' % i)
+    >>> '%040x' % 0 in store, '%040x' % 3 in store
+    (False, True)
+    >>> store.compact()
+    (0, 0)
+    >>> store.segment = lambda: '29990101'
+    >>> store.compact()
+    (1, 1)
+    >>> os.listdir(os.path.join(datapath, 'packs')), store.read('%040x' % 3)
+    (['29990101.pack'], '<p>3</p>')
+    >>> store.close()
+    >>> shutil.rmtree(datapath); shutil.rmtree(workdir)
+'''
+
+import fcntl
+import mmap
+import os
+import os.path
+import threading
+import time
+
+from itertools import islice
+
+
+class PackStore(object):
+    '''
+    Append entries to pack files under `datapath`/`root`, one per day,
+    with their offsets in table `pack` of `db`.
+
+    Entries are read through memory maps of the packs, and written into
+    the working directory of a bundle by `export`. Removed entries leave
+    dead bytes in their pack, reclaimed by `compact`.
+    '''
+
+    _INIT_SQL = '''
+CREATE TABLE IF NOT EXISTS pack
+(
+ digest TEXT NOT NULL PRIMARY KEY,
+ segment TEXT NOT NULL,
+ offset INTEGER NOT NULL,
+ length INTEGER NOT NULL
+)
+'''
+
+    _INDEX_SQL = '''
+CREATE INDEX IF NOT EXISTS ix_pack_segment ON pack (segment)
+'''
+
+    def __init__(self, db, datapath, root='packs', entries='entries'):
+        self._db = db
+        # kindlegen runs in another directory
+        self._dirname = os.path.abspath(os.path.join(datapath, root))
+        self._entries = entries
+        self._maps = {}
+        # maps are shared by threads building bundles
+        self._lock = threading.Lock()
+        self._active = None
+        db.query(self._INIT_SQL)
+        db.query(self._INDEX_SQL)
+
+
+    def segment(self):
+        '''Return name of the pack new entries are appended to.'''
+        return time.strftime('%Y%m%d')
+
+
+    def _filename(self, segment):
+        return os.path.join(self._dirname, segment + '.pack')
+
+
+    def path(self, digest):
+        '''Return path of entry file in the working directory of a bundle.'''
+        return os.path.join(self._entries, digest + '.html')
+
+
+    def _append(self, data):
+        '''
+        Append `data` to the active pack, return its segment and offset.
+        Packs are locked while written, as other processes append to them.
+        '''
+        segment = self.segment()
+        if self._active is None or self._active[0] != segment:
+            if self._active is not None:
+                self._active[1].close()
+            if not os.path.exists(self._dirname):
+                os.makedirs(self._dirname, 0755)
+            self._active = (segment, open(self._filename(segment), 'ab'))
+        fo = self._active[1]
+        fcntl.flock(fo.fileno(), fcntl.LOCK_EX)
+        try:
+            fo.seek(0, os.SEEK_END)
+            offset = fo.tell()
+            fo.write(data)
+            # readers map the file, not this buffer
+            fo.flush()
+        finally:
+            fcntl.flock(fo.fileno(), fcntl.LOCK_UN)
+        return segment, offset
+
+
+    def put(self, digest, data):
+        segment, offset = self._append(data)
+        self._db.query('INSERT OR REPLACE INTO pack (digest, segment, offset, length)'
+                       ' VALUES ($digest, $segment, $offset, $length)',
+                       vars={'digest': digest, 'segment': segment,
+                             'offset': offset, 'length': len(data)})
+
+
+    def remove(self, digest):
+        self._db.delete('pack', where='digest=$digest', vars=locals())
+
+
+    def __contains__(self, digest):
+        return bool(self._db.select('pack', what='1', where='digest=$digest', vars=locals()))
+
+
+    def _map(self, segment, end):
+        m = self._maps.get(segment)
+        if m is None or len(m) < end:
+            # the pack has grown since mapped
+            if m is not None:
+                m.close()
+            with open(self._filename(segment), 'rb') as fi:
+                m = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+        return m
+
+
+    def _read(self, e):
+        if not e.length:
+            return ''
+        with self._lock:
+            return self._map(e.segment, e.offset + e.length)[e.offset:e.offset + e.length]
+
+
+    def read(self, digest):
+        '''Return entry of `digest`, or None if not stored.'''
+        for e in self._db.select('pack', where='digest=$digest', vars=locals()):
+            return self._read(e)
+
+
+    def export(self, digests, workdir):
+        '''
+        Write entries of `digests` into `workdir` at their paths,
+        return paths of the written files.
+        '''
+        dirname = os.path.join(workdir, self._entries)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        paths = []
+        digests = iter(digests)
+        while True:
+            chunk = list(islice(digests, 500))
+            if not chunk:
+                break
+            # read packs in order of their offsets
+            for e in self._db.select('pack', where='digest IN $chunk',
+                                     order='segment, offset', vars=locals()):
+                path = self.path(str(e.digest))
+                with open(os.path.join(workdir, path), 'wb') as fo:
+                    fo.write(self._read(e))
+                paths.append(path)
+        return paths
+
+
+    def compact(self, ratio=0.5):
+        '''
+        Rewrite live entries of the packs, except the active one, whose
+        removed bytes exceed `ratio` of their size; drop packs having no
+        live entries. Return tuple of rewritten entry and dropped pack counts.
+        '''
+        db = self._db
+        active = self.segment()
+        live = dict((s.segment, s.size) for s in db.query(
+                'SELECT segment, sum(length) size FROM pack GROUP BY segment'))
+        moved = 0
+        dropped = 0
+        if not os.path.exists(self._dirname):
+            return (moved, dropped)
+        for name in sorted(os.listdir(self._dirname)):
+            segment, ext = os.path.splitext(name)
+            if ext != '.pack' or segment == active:
+                continue
+            size = os.path.getsize(self._filename(segment))
+            if live.get(segment, 0) > size * (1 - ratio):
+                continue
+            with db.transaction():
+                for e in list(db.select('pack', where='segment=$segment',
+                                        order='offset', vars=locals())):
+                    newSegment, offset = self._append(self._read(e))
+                    db.update('pack', where='digest=$digest', vars={'digest': e.digest},
+                              segment=newSegment, offset=offset)
+                    moved += 1
+            with self._lock:
+                m = self._maps.pop(segment, None)
+                if m is not None:
+                    m.close()
+            os.remove(self._filename(segment))
+            dropped += 1
+        return (moved, dropped)
+
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+        if self._active is not None:
+            self._active[1].close()
+            self._active = None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
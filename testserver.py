@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+'''
+Local HTTP server serving the files of a directory, used by doctests and
+benchmarks to fetch `samples/` over real sockets.
+
+    >>> from urllib2 import urlopen
+    >>> with SampleServer() as server:
+    ...     resp = urlopen(server.url('ifanr.rss2.xml'))
+    ...     resp.code, resp.headers.get('content-type')
+    (200, 'application/xml')
+
+And local SMTP server keeping the received messages:
+
+    >>> import smtplib
+    >>> with SmtpSink(refused=['bad@example.com']) as sink:
+    ...     smtp = smtplib.SMTP('127.0.0.1', sink.port)
+    ...     smtp.sendmail('a@example.com', ['b@example.com'], 'Subject: hi\\n\\nhello')
+    ...     try:
+    ...         smtp.sendmail('a@example.com', ['bad@example.com'], 'Subject: hi\\n\\nhello')
+    ...     except smtplib.SMTPDataError as e:
+    ...         print e.smtp_code
+    ...     smtp.quit()
+    {}
+    550
+    (221, 'Bye')
+    >>> [(to, data) for frm, to, data in sink.messages], sink.connections
+    ([(['b@example.com'], 'Subject: hi\\n\\nhello')], 1)
+'''
+
+import asyncore
+import gzip
+import smtpd
+import os
+import os.path
+import posixpath
+import threading
+import time
+import urllib
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+
+class _Handler(SimpleHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    extensions_map = dict(SimpleHTTPRequestHandler.extensions_map)
+    extensions_map['.xml'] = 'application/xml'
+
+    def do_GET(self):
+        delay = self.server.delay
+        if callable(delay):
+            delay = delay(self.path)
+        if delay:
+            time.sleep(delay)
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+        with open(path, 'rb') as fi:
+            body = fi.read()
+        mtime = os.path.getmtime(path)
+        etag = '"%x-%x"' % (int(mtime), len(body))
+        lastModified = self.date_time_string(mtime)
+        if etag == self.headers.get('if-none-match') or \
+                lastModified == self.headers.get('if-modified-since'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        encoding = None
+        if self.server.gzip and 'gzip' in self.headers.get('accept-encoding', ''):
+            buf = StringIO()
+            gz = gzip.GzipFile(fileobj=buf, mode='wb')
+            gz.write(body)
+            gz.close()
+            body = buf.getvalue()
+            encoding = 'gzip'
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?', 1)[0]))
+        parts = [p for p in path.split('/') if p and p not in (os.curdir, os.pardir)]
+        return os.path.join(self.server.root, *parts)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SampleServer(object):
+    '''
+    Serve files under `root` at http://127.0.0.1:<port>/ in a background thread.
+
+    Arguments:
+    - `root`: directory to serve
+    - `delay`: seconds to sleep before each response, or a function
+      mapping the request path to seconds
+    - `gzip`: compress responses if client accepts gzip encoding
+
+    Responses keep connection alive, and answer 304 to matched
+    If-None-Match or If-Modified-Since.
+    '''
+
+    def __init__(self, root='samples', delay=0, gzip=False):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.root = os.path.abspath(root)
+        self._server.delay = delay
+        self._server.gzip = gzip
+        self._thread = None
+
+    def url(self, name=''):
+        return 'http://127.0.0.1:%d/%s' % (self._server.server_address[1], name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _SmtpServer(smtpd.SMTPServer):
+
+    def handle_accept(self):
+        self.sink.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if set(rcpttos) & self.sink.refused:
+            return '550 Mailbox unavailable'
+        self.sink.messages.append((mailfrom, rcpttos, data))
+
+
+class SmtpSink(object):
+    '''
+    Receive mails at 127.0.0.1:`port` in a background thread, and keep
+    them in `messages` as tuples of sender, recipients and data.
+
+    Arguments:
+    - `refused`: recipient addresses whose messages are answered 550
+    '''
+
+    def __init__(self, refused=()):
+        self.messages = []
+        self.connections = 0
+        self.refused = set(refused)
+        self._server = _SmtpServer(('127.0.0.1', 0), None)
+        self._server.sink = self
+        self.port = self._server.socket.getsockname()[1]
+        self._running = False
+        self._thread = None
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self._server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
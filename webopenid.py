@@ -22,6 +22,9 @@ Customization:
 
  - Use session API of web.py to implement openid session,
    make it usable in multi processes deployment.
+
+ - Session loads and saves only requests with a session cookie
+   or under /openid.
 """
 
 import os
@@ -34,18 +37,39 @@ import openid.store.memstore
 session = None                  # Must set after importing this module
 store = openid.store.memstore.MemoryStore()
 
+_secret_key = None
+
 def _secret():
-    try:
-        secret = file('.openid_secret_key').read()
-    except IOError:
-        # file doesn't exist
-        secret = os.urandom(20)
-        file('.openid_secret_key', 'w').write(secret)
-    return secret
+    global _secret_key
+    if _secret_key is None:
+        try:
+            _secret_key = file('.openid_secret_key').read()
+        except IOError:
+            # file doesn't exist
+            _secret_key = os.urandom(20)
+            file('.openid_secret_key', 'w').write(_secret_key)
+    return _secret_key
 
 def _hmac(identity_url):
     return hmac.new(_secret(), identity_url).hexdigest()
 
+class Session(web.session.Session):
+    """Session loaded only for requests having its cookie, or requests
+    under `paths` which start one, so anonymous page views do not touch
+    the store.
+    """
+    __slots__ = web.session.Session.__slots__ + ["_paths"]
+
+    def __init__(self, app, store, initializer=None, paths=('/openid',)):
+        web.session.Session.__init__(self, app, store, initializer)
+        self._paths = paths
+
+    def _processor(self, handler):
+        if self._config.cookie_name not in web.cookies() \
+                and not web.ctx.path.startswith(self._paths):
+            return handler()
+        return web.session.Session._processor(self, handler)
+
 def status():
     oid_hash = web.cookies().get('openid_identity_hash', '').split(',', 1)
     if len(oid_hash) > 1:
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''
+Thread pool running jobs with per-key concurrency limits and a global deadline.
+
+Results are handed back to the calling thread, so callers can keep work
+that must not run concurrently (e.g. database writes) in one place.
+
+    >>> import time
+    >>> from urllib2 import urlopen
+    >>> from testserver import SampleServer
+    >>> names = ['emacsen.atom.xml', 'ifanr.rss2.xml',
+    ...          'ongoing.atom.xml', 'planet_python.rss2.xml']
+    >>> with SampleServer(delay=0.3) as server:
+    ...     start = time.time()
+    ...     pool = WorkerPool(workers=4)
+    ...     fetched = [(job, len(body)) for job, body, error in
+    ...                pool.run(names, lambda n: urlopen(server.url(n)).read())]
+    ...     elapsed = time.time() - start
+    >>> len(fetched), elapsed < 4 * 0.3
+    (4, True)
+
+At most `keyLimit` jobs sharing a key run at the same time:
+
+    >>> def nap(job):
+    ...     time.sleep(0.2)
+    ...     return job
+    >>> start = time.time()
+    >>> sorted(r for j, r, e in WorkerPool(4, keyLimit=1).run('aab', nap, key=str))
+    ['a', 'a', 'b']
+    >>> 0.4 <= time.time() - start < 0.6
+    True
+
+A job whose key can't be made is reported with the error:
+
+    >>> pool = WorkerPool(2, keyLimit=1)
+    >>> sorted((j, e.__class__.__name__)
+    ...        for j, r, e in pool.run([1, 2], nap, key=lambda j: 1 / (j - 1)))
+    [(1, 'ZeroDivisionError'), (2, 'NoneType')]
+
+Jobs without result when the deadline passes are reported as DeadlineExceeded:
+
+    >>> pool = WorkerPool(workers=1, deadline=0.3)
+    >>> [r if e is None else e.__class__.__name__
+    ...  for j, r, e in pool.run([1, 2, 3], nap)]
+    [1, 'DeadlineExceeded', 'DeadlineExceeded']
+'''
+
+import threading
+import time
+
+from collections import deque
+from Queue import Queue, Empty
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class WorkerPool(object):
+
+    def __init__(self, workers=4, keyLimit=None, deadline=None):
+        """
+        Constructor
+        Arguments:
+        - `workers`: number of threads
+        - `keyLimit`: max running jobs sharing a key, None for unlimited
+        - `deadline`: seconds after `run` starts to give up waiting, None for no deadline
+        """
+        self._workers = max(1, workers)
+        self._keyLimit = keyLimit
+        self._deadline = deadline
+        self._expires = None
+
+
+    def remaining(self):
+        '''Return seconds left before the deadline of current run, None if no deadline.'''
+        if self._expires is None:
+            return None
+        return max(0, self._expires - time.time())
+
+
+    def run(self, jobs, fn, key=None):
+        '''
+        Call `fn(job)` for each of `jobs` in worker threads.
+
+        Return iterator of tuple (job, result, error) in completion order,
+        `error` is the exception raised by `fn` or None.
+        `key(job)` groups jobs limited by `keyLimit`, None key is unlimited.
+        '''
+        jobs = list(jobs)
+        if self._deadline is not None:
+            self._expires = time.time() + self._deadline
+        else:
+            self._expires = None
+
+        pending = deque(enumerate(jobs))
+        results = Queue()
+
+        # jobs waiting for a slot of their key, released one by one
+        parked = {}
+        running = {}
+        keys = {}
+        cond = threading.Condition()
+        stopped = threading.Event()
+        limited = lambda k: k is not None and self._keyLimit
+
+        def take():
+            with cond:
+                while not stopped.isSet():
+                    if pending:
+                        return pending.popleft()
+                    if not parked:
+                        return None
+                    # parked jobs are released by running jobs of their key
+                    cond.wait()
+
+        def acquire(i, job, k):
+            with cond:
+                if running.get(k, 0) >= self._keyLimit:
+                    parked.setdefault(k, deque()).append((i, job))
+                    return False
+                running[k] = running.get(k, 0) + 1
+                return True
+
+        def release(k):
+            with cond:
+                running[k] -= 1
+                waiting = parked.get(k)
+                if waiting:
+                    pending.append(waiting.popleft())
+                    if not waiting:
+                        del parked[k]
+                    cond.notify()
+
+        def work():
+            while True:
+                taken = take()
+                if taken is None:
+                    return
+                i, job = taken
+                try:
+                    if i not in keys:
+                        keys[i] = key(job) if key else None
+                except Exception as e:
+                    results.put((i, None, e))
+                    continue
+                k = keys[i]
+                if limited(k) and not acquire(i, job, k):
+                    continue
+                try:
+                    if self.remaining() == 0:
+                        raise DeadlineExceeded()
+                    result = (i, fn(job), None)
+                except Exception as e:
+                    result = (i, None, e)
+                if limited(k):
+                    release(k)
+                results.put(result)
+
+        for n in range(min(self._workers, len(jobs))):
+            t = threading.Thread(target=work)
+            t.setDaemon(True)
+            t.start()
+
+        done = set()
+        try:
+            while len(done) < len(jobs):
+                remaining = self.remaining()
+                if remaining == 0:
+                    break
+                try:
+                    # wake up periodically, blocking get can't be interrupted
+                    i, result, error = results.get(True, min(remaining or 1, 1))
+                except Empty:
+                    continue
+                done.add(i)
+                yield (jobs[i], result, error)
+        finally:
+            stopped.set()
+            with cond:
+                cond.notifyAll()
+
+        for i, job in enumerate(jobs):
+            if i not in done:
+                yield (job, None, DeadlineExceeded())
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **